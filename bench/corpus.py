@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import time
+
+from wsrc import post, revstore, wikipage
+
+WORDS = """the of and to in is it that was for on are with as be at by this from
+or have an not but what all were when we there can more if no out so said up
+about into than them only other new some could time these two may then first
+any way like well also back after use how our work just where most know get
+through year much before good right too mean old same tell boy follow came want
+show around form three small set put end does another large must big even such
+because turn here why ask went men read need land different home us move try
+kind hand picture again change off play spell air away animal house point page
+letter mother answer found study still learn should world high every near add
+food between own below country plant last school father keep tree never start
+city earth eye light thought head under story saw left few while along might
+close something seem next hard open example begin life always those both paper
+together group often run important until children side feet car mile night walk
+white sea began grow took river four carry state once book hear stop without
+second later miss idea enough eat face watch far really almost let above girl
+sometimes mountain cut young talk soon list song being leave family""".split()
+
+BRACES = ["{{{{image:http://example.com/{0}.png}}}}",
+          "{{{{captionright:http://example.com/{0}.png|{1} {2}}}}}",
+          "{{{{{1} {2}}}}}"]
+
+# the synthetic history all starts here, one revision a minute apart
+EPOCH = 1300000000
+
+def pageNames(count, rand):
+    names = set()
+
+    while len(names) < count:
+        names.add("".join(rand.choice(WORDS).capitalize() for i in range(rand.randint(2, 3))))
+
+    return sorted(names)
+
+def pageText(names, rand, size, linkDensity, braceDensity):
+    lines, line = [], []
+
+    for i in range(size):
+        roll = rand.random()
+
+        if roll < linkDensity:
+            target = rand.choice(names)
+
+            if rand.random() < 0.5:     line.append(target)
+            else:                       line.append("[[{0} {1}]]".format(target, rand.choice(WORDS)))
+
+        elif roll < linkDensity + braceDensity:
+            line.append(rand.choice(BRACES).format(i, rand.choice(WORDS), rand.choice(WORDS)))
+
+        elif roll < linkDensity + braceDensity + 0.02:
+            line.append("''{0}''".format(rand.choice(WORDS)))
+
+        else:
+            line.append(rand.choice(WORDS))
+
+        if rand.random() < 0.08:
+            lines.append(" ".join(line))
+            line = []
+
+            if rand.random() < 0.1: lines.append("")
+            if rand.random() < 0.05: lines.append("  " + " ".join(rand.choice(WORDS) for j in range(6)))
+
+    lines.append(" ".join(line))
+    return "\n".join(lines)
+
+def mutate(text, rand):
+    lines = text.splitlines()
+    if not lines: return text
+
+    for i in range(rand.randint(1, 3)):
+        index = rand.randrange(len(lines))
+        lines[index] = " ".join(rand.choice(WORDS) for j in range(rand.randint(3, 12)))
+
+    return "\n".join(lines)
+
+def generate(pageDir, pages=200, revisions=5, size=300, linkDensity=0.05, braceDensity=0.01,
+             seed=0, store="loose"):
+    rand  = random.Random(seed)
+    names = pageNames(pages, rand)
+
+    if not os.path.isdir(pageDir): os.makedirs(pageDir)
+
+    for name in names:
+        postDir = os.path.join(pageDir, name.lower())
+        os.mkdir(postDir)
+
+        revStore = revstore.STORES[store](postDir)
+        text     = pageText(names, rand, size, linkDensity, braceDensity)
+
+        if store == "pack": revStore.load()
+
+        for i in range(revisions):
+            revision = revstore.parseTime(time.strftime(revstore.TIMEFORMAT, time.gmtime(EPOCH + i * 60)))
+            revStore.write(revision, post.Post("irrelevant", fields={"page": text}).rawNoHeader)
+            text = mutate(text, rand)
+
+        metadata = post.Post("metadata", fields={"title": wikipage.formatter.nicify(name)})
+        open(postDir + os.sep + "metadata.txt", "w").write(metadata.rawNoHeader + "\n")
+
+    wikipage.rebuildCatalog(pageDir)
+    return names
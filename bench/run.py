@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import sys, os
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+from wsrc import post, wikipage, wikisearch
+from . import corpus
+
+QUERIES = ["house", "river mountain", "the world", "picture of animal", "nothing matches xyzzy"]
+
+def timed(function, repeat):
+    runs = []
+
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        runs.append(time.perf_counter() - start)
+
+    return {"min": min(runs), "median": statistics.median(runs), "runs": repeat}
+
+def benchmarks(pageDir, searchFile, names):
+    pages   = [wikipage.WikiPage(name, pageDir) for name in names]
+    texts   = [page.getPage() for page in pages]
+    raws    = [page.store.read(revision).splitlines() for page in pages for revision in page.revisionList]
+
+    formatter = wikipage.formatter
+    searcher  = wikisearch.WikiSearcher(searchFile, pageDir)
+
+    # search has to have something to look through even when syncAll is skipped
+    searcher.syncAll()
+
+    def formatContents():
+        for text in texts: formatter.formatContents(text)
+
+    def parsePost():
+        for lines in raws: post.parsePost("revision", lines)
+
+    def construct():
+        for name in names: wikipage.WikiPage(name, pageDir)
+
+    def wordCounts():
+        for name in names: wikipage.WikiPage(name, pageDir).wordCounts()
+
+    def syncAll():
+        searcher.syncAll()
+
+    # every run ranks from the index, searchCached times the repeat queries
+    # the query cache answers
+    def search():
+        searcher.queryCache.clear()
+        for query in QUERIES: searcher.search(query)
+
+    def searchCached():
+        for query in QUERIES: searcher.search(query)
+
+    return searcher, [("formatContents", formatContents), ("parsePost", parsePost), ("WikiPage", construct),
+                      ("wordCounts", wordCounts), ("syncAll", syncAll), ("search", search),
+                      ("searchCached", searchCached)]
+
+def run(args):
+    workDir = tempfile.mkdtemp(prefix="wikibench")
+
+    try:
+        pageDir = workDir + os.sep + "pages"
+        names   = corpus.generate(pageDir, args.pages, args.revisions, args.size,
+                                  args.links, args.braces, args.seed, args.store)
+
+        results = {}
+        searcher, functions = benchmarks(pageDir, workDir + os.sep + "searchDB", names)
+
+        for name, function in functions:
+            if args.only and name not in args.only: continue
+
+            results[name] = timed(function, args.repeat)
+            print("{0:<16} {1:10.4f}s (median {2:.4f}s)".format(name, results[name]["min"],
+                                                                 results[name]["median"]), file=sys.stderr)
+
+        searcher.close()
+
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    config = {key: getattr(args, key) for key in ("pages", "revisions", "size", "links", "braces", "seed", "store")}
+
+    return {"config": config, "python": platform.python_version(), "results": results}
+
+def compare(old, new, tolerance):
+    if old["config"] != new["config"]:
+        print("warning: runs used different corpora", file=sys.stderr)
+
+    slower = []
+
+    print("{0:<16} {1:>10} {2:>10} {3:>8}".format("benchmark", "old", "new", "ratio"))
+
+    for name in sorted(set(old["results"]) & set(new["results"])):
+        before = old["results"][name]["min"]
+        after  = new["results"][name]["min"]
+        ratio  = after / before if before else float("inf")
+
+        print("{0:<16} {1:10.4f} {2:10.4f} {3:8.2f}".format(name, before, after, ratio))
+        if ratio > tolerance: slower.append(name)
+
+    if slower: print("slower than {0}x: {1}".format(tolerance, ", ".join(slower)))
+    return not slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m bench",
+                                     description="Time the wiki's hot paths on a generated corpus.")
+    parser.add_argument("-n", "--pages", type=int, default=200)
+    parser.add_argument("-r", "--revisions", type=int, default=5, help="revisions per page")
+    parser.add_argument("-w", "--size", type=int, default=300, help="words per page")
+    parser.add_argument("-l", "--links", type=float, default=0.05, help="fraction of words that are links")
+    parser.add_argument("-b", "--braces", type=float, default=0.01, help="fraction of words that are brace classes")
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("--store", choices=["loose", "pack", "log"], default="loose")
+    parser.add_argument("-k", "--repeat", type=int, default=3)
+    parser.add_argument("-o", "--output", metavar="FILE", help="write the results here as JSON")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="only run these benchmarks")
+    parser.add_argument("-c", "--compare", nargs="+", metavar="FILE",
+                        help="compare OLD [NEW] result files instead; NEW defaults to a fresh run")
+    parser.add_argument("-t", "--tolerance", type=float, default=1.2,
+                        help="ratio above which --compare reports a regression (default 1.2)")
+
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) > 1:
+        old, new = (json.load(open(filename)) for filename in args.compare[:2])
+    else:
+        new = run(args)
+
+        if args.output:
+            json.dump(new, open(args.output, "w"), indent=2, sort_keys=True)
+        elif not args.compare:
+            json.dump(new, sys.stdout, indent=2, sort_keys=True)
+            print()
+
+        if not args.compare: return 0
+
+        old = json.load(open(args.compare[0]))
+
+    return 0 if compare(old, new, args.tolerance) else 1
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import sys, os
+import argparse
+import random
+
+from wsrc import wikiformat, wikipage
+
+CORPUS = [
+    "",
+    "plain words only",
+    "FooBar and MainPage and HTTPServer and iPhone and ABCdef",
+    "FooBarBaz Foo-Bar- Foo_Bar_ xHTTPServer Page2Go 3D",
+    "[[SandBox]] [[HelpPage some help]] [[HelpPage ''bold'' help]]",
+    "[[http://example.com/a?b=1&c=2 example link]] [[www.example.com/x the site]]",
+    "[[not a link]] [[ ]] [[  code inside]] [[]]] [[a]b]]",
+    "[[Nested [[FooBar]] thing]] and [[outer [[Inner text]] more]]",
+    "{{Word}} {{some stuff}} {{  code}} {{ }}",
+    "{{image:http://x/y.png}} {{imageLeft:http://x/y.png}} {{imageright:a.png}}",
+    "{{caption:http://x/y.png|A FooBar caption}} {{captionleft:u.png|''bold'' cap|extra}}",
+    "{{caption:u|[[SandBox]] inner}} {{caption:u|  code caption}} {{caption:u| }}",
+    "{{unknown:thing}} {{Unknown:a|b}}",
+    "''bold'' '''italic''' ''''four'''' x''y''z '' unmatched",
+    "''across [[FooBar]] tokens'' and '''[[HelpPage help]]'''",
+    "a & b < c > d &#45; e \"quoted\" don't",
+    "  code line\n  more code\n\n  code after blank\nnormal line",
+    "line one\n\n\nline two\n   three spaces\n\t\ttabbed",
+    "http://bare.com/x www.bare.com/y",
+    "[[SandBox]]{{Word}}FooBar''x''[[a b]]",
+]
+
+def fuzzCorpus(count, seed=0):
+    rand   = random.Random(seed)
+    pieces = [piece for text in CORPUS for piece in text.replace("\n", " ").split(" ")
+                    if piece and "://" not in piece and "www." not in piece]
+    pieces += ["[[", "]]", "{{", "}}", "''", "'''", "|", ":", "  ", " "]
+
+    # an unterminated [[url sends the legacy formatter's URLRE into
+    # exponential backtracking, so URLs only ever show up whole
+    urls = ["[[http://example.com/a?b=1&c=2 example link]]", "[[www.example.com/x the site]]",
+            "http://bare.com/x", "www.bare.com/(y)"]
+
+    ret = []
+
+    for i in range(count):
+        lines = []
+
+        for j in range(rand.randint(1, 20)):
+            line = ""
+
+            for k in range(rand.randint(0, 12)):
+                if rand.random() < 0.05:
+                    line += " " + rand.choice(urls) + " "
+                else:
+                    line += rand.choice(pieces) + rand.choice(["", "", " ", ",", "|"])
+
+            if rand.random() < 0.1: line = "  " + line
+            lines.append(line)
+
+        ret.append("\n".join(lines))
+
+    return ret
+
+def pageCorpus(pageDir):
+    for page in sorted(os.listdir(pageDir)):
+        if not os.path.isdir(pageDir + os.sep + page): continue
+
+        try:
+            wikiPage = wikipage.WikiPage(page, pageDir)
+        except ValueError:
+            continue
+
+        for revision in wikiPage.revisionList:
+            yield "{} ({})".format(page, revision), wikiPage.getPage(revision)
+
+def check(name, text, legacy, current):
+    expected = legacy.formatContents(text)
+    got      = current.formatContents(text)
+
+    if expected == got: return True
+
+    print("MISMATCH in {}:".format(name))
+    print("  source:   {!r}".format(text[:200]))
+    print("  legacy:   {!r}".format(expected[:200]))
+    print("  current:  {!r}".format(got[:200]))
+    return False
+
+
+parser = argparse.ArgumentParser(description="Compare WikiFormatter output against the legacy regex formatter.")
+parser.add_argument("-p", "--pages", metavar="DIR", help="also check every revision under this pages directory")
+parser.add_argument("-f", "--fuzz", type=int, default=500, metavar="N",
+                    help="number of generated pages to check (default 500)")
+parser.add_argument("-s", "--seed", type=int, default=0)
+
+args = parser.parse_args()
+
+legacy  = wikiformat.LegacyFormatter()
+current = wikiformat.WikiFormatter()
+
+cases = [("corpus #{}".format(i), text) for i, text in enumerate(CORPUS)]
+cases += [("fuzz #{}".format(i), text) for i, text in enumerate(fuzzCorpus(args.fuzz, args.seed))]
+
+if args.pages:
+    cases += list(pageCorpus(args.pages))
+
+failed = [name for name, text in cases if not check(name, text, legacy, current)]
+
+print("{} of {} cases match".format(len(cases) - len(failed), len(cases)))
+sys.exit(1 if failed else 0)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+
+from wsrc import wikidump, wikipage, wikisearch, revstore
+
+common = argparse.ArgumentParser(add_help=False)
+common.add_argument("-d", "--pages", default="pages", metavar="DIR",
+                    help="pages directory (default \"pages\")")
+common.add_argument("-f", "--format", choices=wikidump.FORMATS,
+                    help="dump format (default: \"tar\" for .tar/.tar.gz/.tgz files, \"jsonl\" otherwise)")
+
+parser = argparse.ArgumentParser(description="Dump the wiki's pages and history, or load them back in bulk.")
+
+commands = parser.add_subparsers(dest="command")
+commands.required = True
+
+export = commands.add_parser("export", parents=[common], help="write every page and revision out as a dump")
+export.add_argument("-z", "--gzip", action="store_true", help="compress a tar dump")
+export.add_argument("file", nargs="?", default="-", help="where to write it (default stdout)")
+export.add_argument("page", nargs="*", help="only dump these pages")
+
+load = commands.add_parser("import", parents=[common], help="add the pages and revisions in a dump to the wiki")
+load.add_argument("-k", "--kind", choices=sorted(revstore.STORES), default=wikipage.DEFAULTSTORE,
+                  help="history format for new pages (default \"{0}\")".format(wikipage.DEFAULTSTORE))
+load.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                  help="index the imported pages in N worker processes")
+load.add_argument("-n", "--no-index", action="store_true", help="leave the search index alone")
+load.add_argument("file", nargs="?", default="-", help="dump to read (default stdin)")
+
+args = parser.parse_args()
+dumpFormat = args.format or wikidump.guessFormat(args.file)
+
+if args.command == "export":
+    pages = [page.lower() for page in args.page] or None
+    records = wikidump.iterRecords(args.pages, pages)
+
+    if dumpFormat == "tar":
+        outFile = sys.stdout.buffer if args.file == "-" else open(args.file, "wb")
+        count = wikidump.writeTar(records, outFile, args.gzip or args.file.endswith(("gz", ".tgz")))
+    else:
+        outFile = sys.stdout if args.file == "-" else open(args.file, "w", encoding="utf-8")
+        count = wikidump.writeJSONL(records, outFile)
+
+    outFile.flush()
+    print("{0} revisions".format(count), file=sys.stderr)
+
+else:
+    if dumpFormat == "tar":
+        inFile  = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+        records = wikidump.readTar(inFile)
+    else:
+        inFile  = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+        records = wikidump.readJSONL(inFile)
+
+    imported, skipped = wikidump.importRecords(records, args.pages, args.kind, debug=True)
+
+    if not args.no_index:
+        searcher = wikisearch.WikiSearcher(pageDir=args.pages)
+        searcher.syncPages(sorted(page for page, count in imported.items() if count), False, args.jobs)
+        searcher.sync()
+        searcher.updateTermDictionary()
+        searcher.close()
+
+    print("{0} revisions in {1} pages, {2} skipped".format(sum(imported.values()), len(imported), skipped))
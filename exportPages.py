@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import os, shutil
+import re
+import argparse
+import json
+import multiprocessing
+import tempfile
+
+import index
+from wsrc import wikipage, catalog
+
+STATEFILE   = "export.json"
+STYLESHEET  = "wiki.css"
+
+HREFRE      = re.compile(r'href="\?([^"]*)"')
+ACTIONRE    = re.compile(r'action="index\.py"')
+
+# what every page's export needs, sent to each worker once, see initWorker
+settings    = {}
+
+def staticName(page, revision=None):
+    if revision is None: return page + ".html"
+    return "{0}.{1}.html".format(page, revision)
+
+def linkTarget(name):
+    if not wikipage.WikiPage.validTitle(name):
+        name = wikipage.formatter.unnicify(name)
+
+    if not wikipage.WikiPage.validTitle(name): return None
+    return name.lower()
+
+# points ?page= links at the exported files; anything with no file behind
+# it (sources, missing pages, history when it isn't exported) goes back to
+# the dynamic side
+def rewriteLinks(html, page, latest, existing, history, dynamic):
+    def rewrite(match):
+        query  = match.group(1)
+        params = dict(part.partition("=")[::2] for part in re.split("[;&]", query))
+        target = linkTarget(params.pop("page", ""))
+        rev    = params.pop("rev", None)
+
+        if params or target is None or target not in existing:
+            return "href=\"{0}?{1}\"".format(dynamic, query)
+
+        if rev is None or (target == page and rev == str(latest)):
+            return "href=\"{0}\"".format(staticName(target))
+
+        if history and target == page:
+            return "href=\"{0}\"".format(staticName(target, rev))
+
+        return "href=\"{0}?{1}\"".format(dynamic, query)
+
+    html = HREFRE.sub(rewrite, html)
+    return ACTIONRE.sub("action=\"{0}\"".format(dynamic), html)
+
+def writeFile(filename, text, modified):
+    fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+
+    with os.fdopen(fd, "w", encoding="utf-8") as tmpFile:
+        tmpFile.write(text)
+
+    os.replace(tmpName, filename)
+    os.utime(filename, (modified, modified))
+
+def initWorker(options):
+    settings.update(options)
+
+# -> (page, {file: tag}, files written); a file whose tag matches the last
+# run is left alone, see WikiPage.validators
+def exportPage(job):
+    page, previous = job
+    pageDir, outDir, history = settings["pageDir"], settings["outDir"], settings["history"]
+    dynamic, existing        = settings["dynamic"], settings["existing"]
+
+    wikiPage = wikipage.WikiPage(page, pageDir)
+
+    if not wikiPage.exists: return page, {}, 0
+
+    latest    = wikiPage.revisionList[0]
+    revisions = [None] + (wikiPage.revisionList[1:] if history else [])
+    files     = {}
+    written   = 0
+
+    for revision in revisions:
+        filename      = staticName(page, revision)
+        tag, modified = wikiPage.validators(latest if revision is None else revision)
+        tag           = "{0}-{1}".format(index.PAGEVERSION, tag)
+
+        files[filename] = tag
+        if previous.get(filename) == tag and os.path.isfile(outDir + os.sep + filename): continue
+
+        pageDict = {"inner": wikiPage.getHTML(latest if revision is None else revision),
+                    "title": wikiPage.niceName}
+
+        html = "".join(index.iterPage(pageDict))
+        html = rewriteLinks(html, page, latest, existing, history, dynamic)
+
+        writeFile(outDir + os.sep + filename, html, modified)
+        written += 1
+
+    return page, files, written
+
+def loadState(outDir):
+    try:
+        return json.load(open(outDir + os.sep + STATEFILE, encoding="utf-8"))
+    except (IOError, ValueError):
+        return {}
+
+def saveState(outDir, state):
+    fd, tmpName = tempfile.mkstemp(dir=outDir, suffix=".tmp")
+
+    with os.fdopen(fd, "w", encoding="utf-8") as tmpFile:
+        json.dump(state, tmpFile, sort_keys=True)
+
+    os.replace(tmpName, outDir + os.sep + STATEFILE)
+
+def exportAll(pageDir, outDir, workers=1, history=False, dynamic="index.py", force=False, debug=False):
+    if not os.path.isdir(outDir): os.makedirs(outDir)
+
+    pageCatalog = catalog.getCatalog(pageDir)
+    if pageCatalog.existing() is None: wikipage.rebuildCatalog(pageDir)
+
+    existing = pageCatalog.existing()
+    state    = loadState(outDir)
+    options  = {"history": history, "dynamic": dynamic}
+
+    oldFiles = state.get("pages", {})
+    oldTags  = oldFiles
+
+    # different options mean different links everywhere
+    if force or state.get("options") != options: oldTags = {}
+
+    pages    = {}
+    jobs     = [(page, oldTags.get(page, {})) for page in sorted(existing)]
+    shared   = {"pageDir": pageDir, "outDir": outDir, "history": history, "dynamic": dynamic, "existing": existing}
+    total    = 0
+
+    with multiprocessing.Pool(workers, initWorker, (shared,)) as pool:
+        for page, files, written in pool.imap_unordered(exportPage, jobs, 4):
+            if files: pages[page] = files
+            total += written
+
+            if debug and written: print("{0}: {1} files".format(page, written))
+
+    # pages that went away and history that got purged
+    for page, files in oldFiles.items():
+        for filename in set(files) - set(pages.get(page, {})):
+            try:
+                os.remove(outDir + os.sep + filename)
+            except OSError:
+                pass
+
+    if os.path.isfile(STYLESHEET):
+        shutil.copy2(STYLESHEET, outDir + os.sep + STYLESHEET)
+
+    if "mainpage" in pages:
+        shutil.copy2(outDir + os.sep + staticName("mainpage"), outDir + os.sep + "index.html")
+
+    saveState(outDir, {"options": options, "pages": pages})
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the wiki into static HTML files.")
+    parser.add_argument("-d", "--pages", default="pages", metavar="DIR",
+                        help="pages directory (default \"pages\")")
+    parser.add_argument("-o", "--output", default="static", metavar="DIR",
+                        help="where the HTML goes (default \"static\")")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(), metavar="N",
+                        help="render pages in N worker processes (default one per CPU)")
+    parser.add_argument("-r", "--history", action="store_true",
+                        help="also export every older revision")
+    parser.add_argument("-u", "--dynamic", default="index.py", metavar="URL",
+                        help="where links the export can't serve point to (default \"index.py\")")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="re-export everything, not just what changed since the last run")
+
+    args = parser.parse_args()
+
+    count = exportAll(args.pages, args.output, args.jobs, args.history, args.dynamic, args.force, True)
+    print("{0} files written".format(count))
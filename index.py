@@ -1,24 +1,73 @@
 #!/usr/bin/python3
 
-import sys, os, string
+import sys, os
 import cgi, cgitb
+import hashlib
+import email.utils
+import threading
+import zlib
 
 if __name__ == "__main__": cgitb.enable()
 
-from wsrc import wikipage, wikisearch, post
+from wsrc import wikipage, wikisearch, post, catalog, linkgraph, timing
+
+pageText = open("wiki.html").read()
+pageHead, pageTail = wikipage.splitTemplate(pageText, "inner")
+
+PAGEVERSION = hashlib.sha1((wikipage.TEMPLATEVERSION + pageText).encode("utf-8")).hexdigest()[:16]
+
+LISTTEMPLATE = """\
+<div class="wikiList">
+  <div class="listHead">{head}</div>
+  <ul class="listItems">
+{items}
+  </ul>
+</div>"""
+
+ITEMTEMPLATE = """    <li class="listItem"><a href="?page={page}">{title}</a>{extra}</li>"""
+
+SEARCHCOUNT     = 20
+MAXSEARCHCOUNT  = 200
+
+# streamed pages are written out in pieces of about this many characters
+CHUNKSIZE       = 65536
+
+# the searcher, timing and the page caches are per process and not
+# thread-safe, so a threaded WSGI server gets one request at a time, its
+# streaming included; see application
+requestLock = threading.Lock()
+
+searcher = None
+
+def getSearcher():
+    global searcher
+
+    if searcher is None:
+        searcher = wikisearch.WikiSearcher()
+    else:
+        searcher.refresh()
+
+    return searcher
+
+def closeSearcher():
+    global searcher
+
+    if searcher is not None:
+        searcher.close()
+        searcher = None
 
 def getPage(args):
     inner = title = ""
 
     try:
         page  = wikipage.WikiPage(args["page"], tryUnnicify=True)
-        inner = page.getHTML(args["rev"], args["source"])
+        inner = page.iterHTML(args["rev"], args["source"])
         title = page.niceName
 
     except ValueError:
         inner = "Invalid page name \"{0}\".".format(args["page"])
         title = "Invalid page"
-    
+
     return {"inner": inner, "title": title}
 
 def addPage(args):
@@ -29,7 +78,7 @@ def addPage(args):
         newRev = post.Post("irrelevant", fields={"page": args["text"]})
         page   = wikipage.WikiPage(args["page"])
         revNum = page.addRevision(newRev)
-        search = wikisearch.WikiSearcher()
+        search = getSearcher()
         search.syncPageObject(page, revNum, add=True)
         search.sync()
 
@@ -54,31 +103,107 @@ def searchPage(args):
         title = "Search - <none>"
     else:
         query = args["q"]
-        searcher = wikisearch.WikiSearcher()
-        inner = searcher.searchHTML(query)
+        inner = getSearcher().searchHTML(query, args["count"], args["start"])
         title = "Search - \"{}\"".format(query)
 
     return {"inner": inner, "title": title}
 
+def existingPages():
+    return catalog.getCatalog("pages").existing() or set()
+
+def pageTitle(page):
+    entry = catalog.getCatalog("pages").get(page)
+
+    if entry is None:   return wikipage.formatter.nicify(page[0].upper() + page[1:])
+    else:               return entry["title"]
+
+def pageList(head, pages, extra=None):
+    items = []
+
+    for page in pages:
+        formatDict = {"page": cgi.escape(page), "title": cgi.escape(pageTitle(page)), "extra": ""}
+        if extra: formatDict["extra"] = extra(page)
+
+        items.append(ITEMTEMPLATE.format(**formatDict))
+
+    if not items: items = ["    <li class=\"listItem\">None.</li>"]
+
+    return LISTTEMPLATE.format(head=head, items="\n".join(items))
+
+def backlinksPage(args):
+    name = args["page"]
+
+    if not wikipage.WikiPage.validTitle(name):
+        name = wikipage.formatter.unnicify(name)
+
+    if not wikipage.WikiPage.validTitle(name):
+        return {"inner": "Invalid page name \"{0}\".".format(args["page"]), "title": "Invalid page"}
+
+    title     = cgi.escape(pageTitle(name.lower()))
+    backlinks = linkgraph.getLinkGraph("pages").backlinks(name.lower())
+
+    return {"inner": pageList("Pages linking to {0}".format(title), backlinks),
+            "title": "Links to {0}".format(title)}
+
+def orphansPage(args):
+    orphans = linkgraph.getLinkGraph("pages").orphans(existingPages())
+
+    return {"inner": pageList("Pages nothing links to", orphans),
+            "title": "Orphaned pages"}
+
+def wantedPage(args):
+    graph  = linkgraph.getLinkGraph("pages")
+    wanted = graph.wanted(existingPages())
+    pages  = sorted(wanted, key=(lambda page: (-len(wanted[page]), page)))
+
+    def extra(page):
+        return " (linked from {0})".format(len(wanted[page]))
+
+    return {"inner": pageList("Pages linked to but never written", pages, extra),
+            "title": "Wanted pages"}
+
+STATSTEMPLATE = """\
+<div class="wikiList">
+  <div class="listHead">Timings over the last {requests} requests (ms)</div>
+  <table class="wikiStats">
+    <tr><th>span</th><th>requests</th><th>p50</th><th>p90</th><th>p99</th></tr>
+{rows}
+  </table>
+</div>"""
+
+STATSROW = """    <tr><td>{0}</td><td>{1}</td><td>{2:.2f}</td><td>{3:.2f}</td><td>{4:.2f}</td></tr>"""
+
+def statsPage(args):
+    if not timing.ENABLED:
+        return {"inner": "Timing is off; set WIKI_TIMING to turn it on.", "title": "Stats"}
+
+    requests = timing.recentRequests()
+    rows     = [STATSROW.format(cgi.escape(name), *values) for name, values in timing.summarize(requests).items()]
+
+    return {"inner": STATSTEMPLATE.format(requests=len(requests), rows="\n".join(rows)),
+            "title": "Stats"}
+
 modes = {
     "get": getPage,
     "add": addPage,
-    "search": searchPage
+    "search": searchPage,
+    "backlinks": backlinksPage,
+    "orphans": orphansPage,
+    "wanted": wantedPage,
+    "stats": statsPage,
 }
 
-if __name__ == "__main__":
-    pageDict = {}; args = {}
+def parseArgs(form):
+    args = {}
 
-    form = cgi.FieldStorage()
     for i in form: args[i] = form[i].value
-    del form
 
     if "page" not in args: args["page"] = "MainPage"
     if "source" not in args: args["source"] = 0
     if "rev" not in args: args["rev"] = -1
     if "mode" not in args: args["mode"] = "get"
-
-    pageName = cgi.escape(args["page"])
+    if "start" not in args: args["start"] = 0
+    if "count" not in args: args["count"] = SEARCHCOUNT
 
     try: args["source"] = int(args["source"])
     except ValueError: args["source"] = False
@@ -86,17 +211,239 @@ if __name__ == "__main__":
     try: args["rev"] = int(args["rev"])
     except ValueError: args["rev"] = False
 
+    try: args["start"] = int(args["start"])
+    except ValueError: args["start"] = 0
+
+    try: args["count"] = int(args["count"])
+    except ValueError: args["count"] = SEARCHCOUNT
+
+    if args["count"] < 1: args["count"] = SEARCHCOUNT
+    args["count"] = min(args["count"], MAXSEARCHCOUNT)
+
     if "q" in args: args["mode"] = "search"
 
+    return args
+
+def iterHandle(args):
+    pageDict = {}
+
     if args["mode"] not in modes:
         mode = modes["get"]
     else:
         mode = modes[args["mode"]]
 
-    pageDict.update(mode(args))
+    with timing.span("mode"):
+        pageDict.update(mode(args))
+
+    # whatever the request did to the index is committed now, not whenever
+    # the searcher happens to get collected
+    if searcher is not None: searcher.sync()
+
+    return iterPage(pageDict)
+
+# the page around "inner", which is either a string or an iterator of them
+# (see WikiPage.iterHTML); the head goes out before any of it is formatted
+def iterPage(pageDict):
+    inner = pageDict.pop("inner")
+    if isinstance(inner, str): inner = [inner]
+
+    with timing.span("page"):
+        yield pageHead.safe_substitute(pageDict)
+        yield from inner
+        yield pageTail.safe_substitute(pageDict)
+
+def handle(args):
+    return "".join(iterHandle(args))
+
+def chunked(pieces, size=CHUNKSIZE):
+    buffered = []
+    length   = 0
+    first    = True
+
+    for piece in pieces:
+        # the first piece is the page head, don't hold it back
+        if first:
+            first = False
+            yield piece
+            continue
+
+        buffered.append(piece)
+        length += len(piece)
+        if length < size: continue
+
+        # a cached page comes in as one piece, it still goes out in parts
+        text = "".join(buffered)
+        end  = length - length % size
+
+        for start in range(0, end, size):
+            yield text[start:start + size]
+
+        buffered, length = [text[end:]], length - end
+
+    if length: yield "".join(buffered)
+
+# the caller resets timing, see respond
+def timedHandle(args):
+    with timing.span("total"):
+        body = handle(args)
+
+    timing.logRequest(mode=args["mode"], page=args["page"])
+
+    headers = []
+    if timing.ENABLED: headers.append(("Server-Timing", timing.serverTiming()))
+
+    return body, headers
+
+# (etag, last modified) for page views, None for everything else
+def validators(args):
+    if args["mode"] in modes and args["mode"] != "get": return None
+
+    try:
+        page = wikipage.WikiPage(args["page"], tryUnnicify=True)
+    except ValueError:
+        return None
+
+    pageTags = page.validators(args["rev"], args["source"])
+    if pageTags is None: return None
+
+    tag, modified = pageTags
+    return "W/\"{0}-{1}\"".format(PAGEVERSION, tag), modified
+
+def notModified(environ, etag, modified):
+    ifNoneMatch = environ.get("HTTP_IF_NONE_MATCH")
+
+    # If-Modified-Since only counts when there's no If-None-Match
+    if ifNoneMatch is not None:
+        tags = [tag.strip() for tag in ifNoneMatch.split(",")]
+        return "*" in tags or etag in tags or etag[2:] in tags
+
+    ifModifiedSince = environ.get("HTTP_IF_MODIFIED_SINCE")
+    if not ifModifiedSince: return False
+
+    try:
+        since = email.utils.parsedate_to_datetime(ifModifiedSince).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return False
+
+    return modified <= since
+
+def acceptsGzip(environ):
+    for coding in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() != "gzip": continue
+
+        quality = params.strip().lower()
+
+        try:
+            return not quality.startswith("q=") or float(quality[2:]) > 0
+        except ValueError:
+            return True
+
+    return False
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    # flushed per chunk so streaming still gets the head out early
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    yield compressor.flush()
+
+# -> (status, headers, byte chunks) for both the CGI and the WSGI side
+def respond(args, environ):
+    timing.reset()
+
+    headers = [("Vary", "Accept-Encoding")]
+
+    with timing.span("validators"):
+        tags = validators(args)
+
+    if tags is not None:
+        etag, modified = tags
+        headers += [("ETag", etag),
+                    ("Last-Modified", email.utils.formatdate(modified, usegmt=True)),
+                    ("Cache-Control", "no-cache")]
+
+        if notModified(environ, etag, modified):
+            timing.logRequest(mode=args["mode"], page=args["page"], status=304)
+            if timing.ENABLED: headers.append(("Server-Timing", timing.serverTiming()))
+
+            return "304 Not Modified", headers, []
+
+    chunks, extra = streamHandle(args)
+    chunks = (chunk.encode("utf-8") for chunk in chunks)
+
+    headers = [("Content-type", "text/html; charset=utf-8")] + headers + extra
+
+    if acceptsGzip(environ):
+        headers.append(("Content-Encoding", "gzip"))
+        chunks = gzipped(chunks)
+
+    return "200 OK", headers, chunks
+
+# -> (chunks, headers); with timing on the page is built whole first, since
+# the Server-Timing header has to go out before any of it
+def streamHandle(args):
+    if timing.ENABLED:
+        body, headers = timedHandle(args)
+        return [body], headers
+
+    return chunked(iterHandle(args)), []
+
+# hands the request lock back once the body has been read or the server
+# closes the response, which WSGI has it do even when it was never read
+class LockedChunks(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.locked = True
+
+    def __iter__(self):
+        try:
+            yield from self.chunks
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.locked: return
+
+        try:
+            if hasattr(self.chunks, "close"): self.chunks.close()
+        finally:
+            self.locked = False
+            requestLock.release()
+
+def application(environ, start_response):
+    requestLock.acquire()
+
+    try:
+        form = cgi.FieldStorage(fp=environ.get("wsgi.input"), environ=environ)
+        args = parseArgs(form)
+        del form
+
+        status, headers, chunks = respond(args, environ)
+        start_response(status, headers)
+    except BaseException:
+        requestLock.release()
+        raise
+
+    return LockedChunks(chunks)
+
+if __name__ == "__main__":
+    form = cgi.FieldStorage()
+    args = parseArgs(form)
+    del form
+
+    status, headers, chunks = respond(args, os.environ)
+
+    print("Status: {0}".format(status))
+    for header in headers: print("{0}: {1}".format(*header))
+    print()
+
+    sys.stdout.flush()
 
-    page = open("wiki.html").read()
-    pageTemplate = string.Template(page)
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
 
-    print("Content-type: text/html\n")
-    print(pageTemplate.safe_substitute(pageDict))
+    closeSearcher()
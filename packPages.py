@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+
+from wsrc import revstore
+
+def diskUsage(postDir):
+    return sum(os.path.getsize(postDir + os.sep + name) for name in os.listdir(postDir))
+
+parser = argparse.ArgumentParser(description="Convert page histories between loose revision files, revision packs and revision logs.")
+parser.add_argument("-d", "--pages", default="pages", metavar="DIR",
+                    help="pages directory (default \"pages\")")
+parser.add_argument("-k", "--kind", choices=sorted(revstore.STORES), default="pack",
+                    help="history format to convert to (default \"pack\")")
+parser.add_argument("-u", "--unpack", action="store_const", dest="kind", const="loose",
+                    help="same as --kind loose")
+parser.add_argument("page", nargs="*", help="only convert these pages")
+
+args = parser.parse_args()
+
+kind  = args.kind
+pages = [page.lower() for page in args.page] or sorted(os.listdir(args.pages))
+
+before = after = 0
+
+for page in pages:
+    postDir = os.path.abspath(args.pages) + os.sep + page
+    if not os.path.isdir(postDir): continue
+
+    size = diskUsage(postDir)
+    count = revstore.convert(postDir, kind)
+
+    before += size
+    after  += diskUsage(postDir)
+
+    if count: print("{0}: {1} revisions".format(page, count))
+
+print("{0} -> {1} bytes".format(before, after))
@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
 from wsrc import wikisearch
 
-searcher = wikisearch.WikiSearcher()
+parser = argparse.ArgumentParser(description="Rebuild or query the wiki search index.")
+parser.add_argument("-i", "--incremental", action="store_true",
+                    help="only reindex pages changed since the last run")
+parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                    help="analyse pages in N worker processes")
+parser.add_argument("-s", "--scoring", choices=wikisearch.SCORING, default=wikisearch.DEFAULTSCORING,
+                    help="how queries are ranked (default \"{}\")".format(wikisearch.DEFAULTSCORING))
+parser.add_argument("query", nargs="*", help="search for this instead of reindexing")
 
-if len(sys.argv) > 1:
-    print(searcher.searchHTML(" ".join(sys.argv[1:])))
+args = parser.parse_args()
+
+searcher = wikisearch.WikiSearcher(scoring=args.scoring)
+
+if args.query:
+    print(searcher.searchHTML(" ".join(args.query)))
+elif args.incremental:
+    searcher.syncChanged(True, args.jobs)
 else:
-    searcher.syncAll(True)
+    searcher.syncAll(True, args.jobs)
+
+searcher.close()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+
+import sys
+from wsgiref.simple_server import make_server
+
+import index
+
+host = "localhost"
+port = 8000
+
+if len(sys.argv) > 1: port = int(sys.argv[1])
+if len(sys.argv) > 2: host = sys.argv[2]
+
+server = make_server(host, port, index.application)
+print("Serving wiki on http://{}:{}/".format(host, port))
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    index.closeSearcher()
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+import os
+import json
+import fcntl
+import tempfile
+import contextlib
+
+CATALOGFILE = "catalog.json"
+LOCKFILE    = "catalog.lock"
+
+catalogs = {}
+
+def getCatalog(pageDir):
+    pageDir = os.path.abspath(pageDir)
+
+    if pageDir not in catalogs:
+        catalogs[pageDir] = PageCatalog(pageDir)
+
+    return catalogs[pageDir]
+
+
+# page name -> {"title", "latest", "revisions", "size"} for every page, kept
+# next to the page directories and read in one go
+class PageCatalog(object):
+    FILENAME = CATALOGFILE
+
+    def __init__(self, pageDir="pages"):
+        self.pageDir        = os.path.abspath(pageDir)
+        self.catalogFile    = self.pageDir + os.sep + self.FILENAME
+        self.lockFile       = self.pageDir + os.sep + LOCKFILE
+        self.entries        = {}
+        self.stamp          = None
+        self.existingPages  = None
+        self.existingStamp  = None
+
+    def load(self):
+        try:
+            stat = os.stat(self.catalogFile)
+        except OSError:
+            self.entries, self.stamp = {}, None
+            return self.entries
+
+        # only re-read when another process has replaced the file
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+        if stamp != self.stamp:
+            self.entries = json.load(open(self.catalogFile, encoding="utf-8"))
+            self.stamp   = stamp
+
+        return self.entries
+
+    def __contains__(self, page):
+        return page in self.load()
+
+    def get(self, page):
+        return self.load().get(page)
+
+    def pages(self):
+        return sorted(self.load())
+
+    # pages with at least one revision, or None before there is a catalog
+    def existing(self):
+        self.load()
+
+        if self.stamp is None: return None
+
+        if self.existingStamp != self.stamp:
+            self.existingPages = {page for page, entry in self.entries.items() if entry["revisions"]}
+            self.existingStamp = self.stamp
+
+        return self.existingPages
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lockFile, "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            yield
+
+    def update(self, entries, replace=False):
+        with self.locked():
+            current = {} if replace else dict(self.load())
+            self.merge(current, entries)
+
+            fd, tmpName = tempfile.mkstemp(dir=self.pageDir, suffix=".tmp")
+
+            with os.fdopen(fd, "w", encoding="utf-8") as tmpFile:
+                json.dump(current, tmpFile, sort_keys=True)
+
+            os.replace(tmpName, self.catalogFile)
+
+        self.entries, self.stamp = current, None
+
+    def merge(self, current, entries):
+        for page, entry in entries.items():
+            if entry is None:   current.pop(page, None)
+            else:               current[page] = entry
+
+    def remove(self, page):
+        self.update({page: None})
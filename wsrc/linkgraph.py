@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+import os
+
+from . import catalog
+
+LINKFILE = "links.json"
+
+graphs = {}
+
+def getLinkGraph(pageDir):
+    pageDir = os.path.abspath(pageDir)
+
+    if pageDir not in graphs:
+        graphs[pageDir] = LinkGraph(pageDir)
+
+    return graphs[pageDir]
+
+
+# page -> {"links": [...], "backlinks": [...]}, covering every page that
+# links or is linked to; updates are given forward links and keep the
+# reverse side in step
+class LinkGraph(catalog.PageCatalog):
+    FILENAME = LINKFILE
+
+    def merge(self, current, entries):
+        for page, links in entries.items():
+            links = set(links or ())
+            entry = dict(current.get(page, {}))
+            old   = set(entry.get("links", ()))
+
+            for target in old - links:
+                self.setBacklinks(current, target, set(self.backlinksIn(current, target)) - {page})
+
+            for target in links - old:
+                self.setBacklinks(current, target, set(self.backlinksIn(current, target)) | {page})
+
+            # the loops above may have rewritten this page's own entry
+            entry = dict(current.get(page, {}))
+            entry["links"] = sorted(links)
+            self.store(current, page, entry)
+
+    @staticmethod
+    def backlinksIn(current, page):
+        return current.get(page, {}).get("backlinks", [])
+
+    def setBacklinks(self, current, page, backlinks):
+        entry = dict(current.get(page, {}))
+        entry["backlinks"] = sorted(backlinks)
+        self.store(current, page, entry)
+
+    @staticmethod
+    def store(current, page, entry):
+        if entry.get("links") or entry.get("backlinks"):
+            current[page] = entry
+        else:
+            current.pop(page, None)
+
+    def links(self, page):
+        return self.load().get(page, {}).get("links", [])
+
+    def backlinks(self, page):
+        return [source for source in self.backlinksIn(self.load(), page) if source != page]
+
+    def orphans(self, existing):
+        return sorted(page for page in existing if not self.backlinks(page))
+
+    def wanted(self, existing):
+        ret = {}
+
+        for page, entry in self.load().items():
+            if page not in existing and entry.get("backlinks"):
+                ret[page] = entry["backlinks"]
+
+        return ret
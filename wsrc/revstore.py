@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+
+import os, shutil
+import time
+import calendar
+import contextlib
+import fcntl
+import mmap
+import struct
+import difflib
+import json
+import tempfile
+import zlib
+
+TIMEFORMAT  = "%Y-%m-%d_%H:%M:%S"
+
+PACKFILE    = "revisions.pack"
+PACKMAGIC   = b"WIKIPACK 1\n"
+
+LOGINDEX    = "revisions.idx"
+LOGFILE     = "revisions.{0}.log"
+LOGLOCK     = "revisions.lock"
+LOGHEADER   = struct.Struct("<8sQ")      # magic, log generation
+LOGRECORD   = struct.Struct("<qQQ")      # revision, offset, length
+LOGMAGIC    = b"WIKILOG1"
+
+FULL        = "full"
+DELTA       = "delta"
+
+# longest run of deltas before a revision gets stored in full again,
+# so materializing anything never walks more than this many steps
+KEYFRAME    = 16
+
+# revision timestamps are the gmtime strings read back as local time
+def parseTime(name):
+    return int(time.mktime(time.strptime(name, TIMEFORMAT)))
+
+def formatTime(revision):
+    return time.strftime(TIMEFORMAT, time.localtime(revision))
+
+# when a page's history last changed: appending to a log, unlike adding a
+# file, leaves the directory's own mtime alone
+def modifiedTime(postDir):
+    ret = os.stat(postDir).st_mtime
+
+    for name in (PACKFILE, LOGINDEX):
+        try:
+            ret = max(ret, os.stat(postDir + os.sep + name).st_mtime)
+        except OSError:
+            pass
+
+    return ret
+
+# seconds since the epoch the revision was actually saved at
+def epochTime(revision):
+    return calendar.timegm(time.localtime(revision))
+
+def makeDelta(base, text):
+    baseLines = base.splitlines(True)
+    lines     = text.splitlines(True)
+    ops       = []
+
+    matcher = difflib.SequenceMatcher(None, baseLines, lines, autojunk=False)
+
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":  ops.append([i1, i2])
+        elif j2 > j1:       ops.append("".join(lines[j1:j2]))
+
+    return zlib.compress(json.dumps(ops).encode("utf-8"))
+
+def applyDelta(base, delta):
+    baseLines = base.splitlines(True)
+    ret       = []
+
+    for op in json.loads(zlib.decompress(delta).decode("utf-8")):
+        if isinstance(op, str): ret.append(op)
+        else:                   ret.extend(baseLines[op[0]:op[1]])
+
+    return "".join(ret)
+
+
+# one file per revision, named after its timestamp
+class LooseStore(object):
+    def __init__(self, postDir):
+        self.postDir    = postDir
+        self.files      = {}
+
+    def revisions(self):
+        self.files = {}
+
+        for revision in os.listdir(self.postDir):
+            try:
+                revTime = parseTime(revision.split(".")[0])
+            except ValueError:
+                continue
+
+            self.files[revTime] = revision
+
+        return list(self.files)
+
+    def read(self, revision):
+        return open(self.postDir + os.sep + self.files[revision]).read()
+
+    def write(self, revision, raw):
+        filename = formatTime(revision) + ".txt"
+
+        newRev = open(self.postDir + os.sep + filename, "w")
+        newRev.write(raw)
+        newRev.close()
+
+        self.files[revision] = filename
+        return revision
+
+    def writeMany(self, texts):
+        return [self.write(revision, texts[revision]) for revision in sorted(texts)]
+
+    def remove(self, revisions):
+        for revision in revisions:
+            os.remove(self.postDir + os.sep + self.files.pop(revision))
+
+    def discard(self, revision):
+        revFile = self.files.pop(revision)
+
+        newRev = list(revFile.partition("."))
+        newRev[0] += "~"
+
+        # make the timestamp check fail from now on
+        shutil.move(self.postDir + os.sep + revFile, self.postDir + os.sep + "".join(newRev))
+
+
+# every revision of a page in one file: the newest in full, older ones as
+# compressed reverse deltas against the next newer revision
+class PackStore(object):
+    def __init__(self, postDir):
+        self.postDir    = postDir
+        self.packFile   = postDir + os.sep + PACKFILE
+        self.entries    = None      # [revision, kind, blob], newest first
+        self.texts      = {}
+
+    def load(self):
+        self.entries = []
+        self.texts   = {}
+
+        try:
+            data = open(self.packFile, "rb").read()
+        except IOError:
+            return
+
+        if not data.startswith(PACKMAGIC):
+            raise ValueError("{0} is not a revision pack".format(self.packFile))
+
+        offset = len(PACKMAGIC)
+        end    = data.index(b"\n", offset)
+        count  = int(data[offset:end])
+        offset = end + 1
+
+        header = []
+
+        for i in range(count):
+            end = data.index(b"\n", offset)
+            revision, kind, length = data[offset:end].decode("ascii").split(" ")
+            header.append((int(revision), kind, int(length)))
+            offset = end + 1
+
+        for revision, kind, length in header:
+            self.entries.append([revision, kind, data[offset:offset + length]])
+            offset += length
+
+    def save(self):
+        if not self.entries:
+            if os.path.exists(self.packFile): os.remove(self.packFile)
+            return
+
+        header = [PACKMAGIC, "{0}\n".format(len(self.entries)).encode("ascii")]
+
+        for revision, kind, blob in self.entries:
+            header.append("{0} {1} {2}\n".format(revision, kind, len(blob)).encode("ascii"))
+
+        fd, tmpName = tempfile.mkstemp(dir=self.postDir, suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as tmpFile:
+            tmpFile.write(b"".join(header))
+
+            for revision, kind, blob in self.entries:
+                tmpFile.write(blob)
+
+        os.replace(tmpName, self.packFile)
+
+    def revisions(self):
+        self.load()
+        return [entry[0] for entry in self.entries]
+
+    def read(self, revision):
+        if self.entries is None: self.load()
+        if revision in self.texts: return self.texts[revision]
+
+        order = [entry[0] for entry in self.entries]
+        index = order.index(revision)
+        start = index
+
+        # walk up to the nearest full copy, then apply deltas back down
+        while self.entries[start][1] != FULL and order[start] not in self.texts:
+            start -= 1
+
+        if order[start] in self.texts:  text = self.texts[order[start]]
+        else:                           text = zlib.decompress(self.entries[start][2]).decode("utf-8")
+
+        for i in range(start + 1, index + 1):
+            text = applyDelta(text, self.entries[i][2])
+
+        self.texts[revision] = text
+        return text
+
+    def rewrite(self, order, texts):
+        old      = {entry[0]: (i, entry) for i, entry in enumerate(self.entries)}
+        entries  = []
+        depth    = 0
+
+        def textOf(revision):
+            if revision in texts: return texts[revision]
+            return self.read(revision)
+
+        for i, revision in enumerate(order):
+            base = order[i - 1] if i else None
+            keep = False
+
+            if revision in old and revision not in texts:
+                j, entry = old[revision]
+                oldBase  = self.entries[j - 1][0] if j else None
+
+                # a full copy stays only where one is due anyway, so the old
+                # head and keyframes that moved along turn back into deltas
+                if entry[1] == FULL:    keep = base is None or depth >= KEYFRAME
+                else:                   keep = base is not None and base == oldBase and depth < KEYFRAME
+
+            if keep:
+                entry = list(entry)
+            elif base is None or depth >= KEYFRAME:
+                entry = [revision, FULL, zlib.compress(textOf(revision).encode("utf-8"))]
+            else:
+                entry = [revision, DELTA, makeDelta(textOf(base), textOf(revision))]
+
+            depth = 0 if entry[1] == FULL else depth + 1
+            entries.append(entry)
+
+        self.entries = entries
+        self.texts   = {revision: text for revision, text in self.texts.items() if revision in order}
+        self.texts.update(texts)
+        self.save()
+
+    def write(self, revision, raw):
+        if self.entries is None: self.load()
+
+        order = sorted(set(entry[0] for entry in self.entries) | {revision}, reverse=True)
+        self.rewrite(order, {revision: raw})
+        return revision
+
+    # the whole batch in one rewrite of the pack
+    def writeMany(self, texts):
+        if self.entries is None: self.load()
+
+        order = sorted(set(entry[0] for entry in self.entries) | set(texts), reverse=True)
+        self.rewrite(order, texts)
+        return sorted(texts)
+
+    def remove(self, revisions):
+        if self.entries is None: self.load()
+
+        order = [entry[0] for entry in self.entries if entry[0] not in revisions]
+        self.rewrite(order, {})
+
+    def discard(self, revision):
+        filename = formatTime(revision) + "~.txt"
+
+        open(self.postDir + os.sep + filename, "w").write(self.read(revision))
+        self.remove({revision})
+
+
+# one append-only log per page, plus an index of fixed-width records
+# pointing into it; the log is only ever rewritten (under a new generation,
+# so readers holding the old index still find their data) once more than
+# half of it is purged revisions
+class LogStore(object):
+    def __init__(self, postDir):
+        self.postDir    = postDir
+        self.indexFile  = postDir + os.sep + LOGINDEX
+        self.lockFile   = postDir + os.sep + LOGLOCK
+        self.generation = 0
+        self.entries    = None      # revision -> (offset, length)
+        self.log        = None
+
+    def logFile(self, generation=None):
+        if generation is None: generation = self.generation
+        return self.postDir + os.sep + LOGFILE.format(generation)
+
+    # held while the index is reloaded and changed, so writers in other
+    # processes neither pick the same timestamp nor drop each other's records
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lockFile, "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            yield
+
+    def load(self):
+        self.entries    = {}
+        self.generation = 0
+        self.log        = None
+
+        try:
+            data = open(self.indexFile, "rb").read()
+        except IOError:
+            return
+
+        magic, self.generation = LOGHEADER.unpack_from(data)
+
+        if magic != LOGMAGIC:
+            raise ValueError("{0} is not a revision log index".format(self.indexFile))
+
+        # a record cut short by a crash is simply not there yet
+        end = len(data) - (len(data) - LOGHEADER.size) % LOGRECORD.size
+
+        for revision, offset, length in LOGRECORD.iter_unpack(data[LOGHEADER.size:end]):
+            self.entries[revision] = (offset, length)
+
+    def revisions(self):
+        self.load()
+        return list(self.entries)
+
+    def read(self, revision):
+        if self.entries is None: self.load()
+
+        offset, length = self.entries[revision]
+
+        # appends since the log was mapped lie past the end of the mapping
+        if self.log is None or offset + length > len(self.log):
+            with open(self.logFile(), "rb") as logFile:
+                self.log = mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self.log[offset:offset + length].decode("utf-8")
+
+    def write(self, revision, raw):
+        with self.locked():
+            self.load()
+
+            # two saves in the same second get consecutive timestamps; always
+            # moving past the newest keeps a purged timestamp from coming back
+            if self.entries: revision = max(revision, max(self.entries) + 1)
+
+            return self.append(revision, raw)
+
+    # imported history keeps its own timestamps, only moving on a collision
+    def writeMany(self, texts):
+        written = []
+
+        with self.locked():
+            self.load()
+
+            for revision in sorted(texts):
+                stored = revision
+                while stored in self.entries: stored += 1
+
+                written.append(self.append(stored, texts[revision]))
+
+        return written
+
+    # append and writeIndex expect the caller to hold the lock
+    def append(self, revision, raw):
+        data = raw.encode("utf-8")
+
+        if not os.path.exists(self.indexFile):
+            self.writeIndex(self.generation)
+
+        with open(self.logFile(), "ab") as logFile:
+            offset = logFile.seek(0, os.SEEK_END)
+            logFile.write(data)
+
+        with open(self.indexFile, "ab") as indexFile:
+            indexFile.write(LOGRECORD.pack(revision, offset, len(data)))
+
+        self.entries[revision] = (offset, len(data))
+        return revision
+
+    def writeIndex(self, generation):
+        records = sorted(self.entries.items(), key=lambda item: item[1])
+        data    = [LOGHEADER.pack(LOGMAGIC, generation)]
+
+        for revision, (offset, length) in records:
+            data.append(LOGRECORD.pack(revision, offset, length))
+
+        fd, tmpName = tempfile.mkstemp(dir=self.postDir, suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as tmpFile:
+            tmpFile.write(b"".join(data))
+
+        os.replace(tmpName, self.indexFile)
+
+    def remove(self, revisions):
+        with self.locked():
+            # the reload keeps records other processes appended meanwhile
+            self.load()
+
+            for revision in revisions:
+                self.entries.pop(revision, None)
+
+            oldLog = self.logFile()
+
+            if not self.entries:
+                for filename in (self.indexFile, oldLog):
+                    if os.path.exists(filename): os.remove(filename)
+
+                self.load()
+                return
+
+            live = sum(length for offset, length in self.entries.values())
+
+            if os.path.getsize(oldLog) <= 2 * live:
+                self.writeIndex(self.generation)
+                return
+
+            texts = {revision: self.read(revision).encode("utf-8") for revision in self.entries}
+            generation = self.generation + 1
+
+            with open(self.logFile(generation), "wb") as logFile:
+                for revision in sorted(texts):
+                    self.entries[revision] = (logFile.tell(), len(texts[revision]))
+                    logFile.write(texts[revision])
+
+            self.writeIndex(generation)
+            self.generation = generation
+            self.log        = None
+
+            os.remove(oldLog)
+
+    def discard(self, revision):
+        filename = formatTime(revision) + "~.txt"
+
+        open(self.postDir + os.sep + filename, "w").write(self.read(revision))
+        self.remove({revision})
+
+
+STORES = {
+    "loose": LooseStore,
+    "pack": PackStore,
+    "log": LogStore,
+}
+
+def openStore(postDir, default="loose"):
+    # a page stays in whatever format it was converted to
+    if os.path.exists(postDir + os.sep + PACKFILE):
+        return PackStore(postDir)
+
+    if os.path.exists(postDir + os.sep + LOGINDEX):
+        return LogStore(postDir)
+
+    return STORES[default](postDir)
+
+def convert(postDir, kind):
+    source = openStore(postDir)
+    target = STORES[kind](postDir)
+
+    if source.__class__ is target.__class__: return 0
+
+    revisions = sorted(source.revisions(), reverse=True)
+    texts     = {revision: source.read(revision) for revision in revisions}
+
+    if kind == "pack":
+        target.load()
+        target.rewrite(revisions, texts)
+    else:
+        for revision in reversed(revisions): target.write(revision, texts[revision])
+
+    source.remove(revisions)
+    return len(revisions)
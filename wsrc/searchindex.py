@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+import os
+import collections
+import contextlib
+import fcntl
+import shelve
+import sqlite3
+import json
+import tempfile
+
+def recordTerms(record):
+    terms = dict(record["words"])
+
+    # title and link words score without appearing in the text, so they
+    # need postings too - with a zero frequency if the text lacks them
+    for word in record["titleWords"] + record["linkWords"]:
+        terms.setdefault(word, 0)
+
+    return terms
+
+def recordLength(record):
+    if "length" in record: return record["length"]
+    return sum(record["words"].values())
+
+def ftsAvailable():
+    try:
+        sqlite3.connect(":memory:").execute("CREATE VIRTUAL TABLE t USING fts5(x)")
+    except sqlite3.OperationalError:
+        return False
+
+    return True
+
+
+class ShelveIndex(object):
+    def __init__(self, searchFile):
+        self.searchFile = searchFile
+
+        # bumped by every commit that changed anything, see generation
+        self.generationFile = searchFile + "Generation"
+        self.lockFile       = searchFile + "Lock"
+        self.dirty          = False
+
+        # term -> postings changed since the last commit; every term gets
+        # written once per commit rather than once per revision using it
+        self.pending        = {}
+
+        self.open()
+
+    def open(self):
+        self.searchDB   = shelve.open(self.searchFile, writeback=True)
+
+        # term -> {page: {revision: term frequency}}
+        self.termDB     = shelve.open(self.searchFile + "Terms")
+
+        # page -> (latest revision, revstore.modifiedTime) as of its last sync
+        self.manifestDB = shelve.open(self.searchFile + "Manifest")
+
+        # "documents" and "length": revision count and total words, for BM25
+        self.metaDB     = shelve.open(self.searchFile + "Meta")
+
+        self.openGeneration = self.storedGeneration()
+
+    # the dbm files keep their own idea of what's in them in memory, so once
+    # another process has committed they have to be opened again
+    def refresh(self):
+        if self.dirty or self.storedGeneration() == self.openGeneration: return
+
+        self.close()
+        self.open()
+
+    def pages(self):
+        return list(self.searchDB)
+
+    def __contains__(self, page):
+        return page in self.searchDB
+
+    def revisions(self, page):
+        return self.searchDB.get(page, {})
+
+    def storeRevision(self, page, revision, record):
+        self.touch()
+        if page not in self.searchDB: self.searchDB[page] = {}
+
+        if revision in self.searchDB[page]:
+            self.removePostings(page, revision)
+
+        self.searchDB[page][revision] = record
+        self.countDocument(record, 1)
+
+        for term, count in recordTerms(record).items():
+            self.changePostings(term).setdefault(page, {})[revision] = count
+
+    def countDocument(self, record, sign):
+        self.metaDB["documents"] = self.metaDB.get("documents", 0) + sign
+        self.metaDB["length"]    = self.metaDB.get("length", 0) + sign * recordLength(record)
+
+    def removePostings(self, page, revision):
+        self.countDocument(self.searchDB[page][revision], -1)
+
+        for term in recordTerms(self.searchDB[page][revision]):
+            postings  = self.changePostings(term)
+            revisions = postings.get(page, {})
+            revisions.pop(revision, None)
+
+            if not revisions: postings.pop(page, None)
+
+    def postings(self, term):
+        if term in self.pending: return self.pending[term]
+        return self.termDB.get(term, {})
+
+    def changePostings(self, term):
+        if term not in self.pending: self.pending[term] = self.termDB.get(term, {})
+        return self.pending[term]
+
+    def removePage(self, page):
+        if page in self.manifestDB: del self.manifestDB[page]
+
+        if page not in self.searchDB: return
+
+        self.touch()
+
+        for revision in list(self.searchDB[page]):
+            self.removePostings(page, revision)
+
+        del self.searchDB[page]
+
+    def terms(self):
+        if not self.pending: return list(self.termDB)
+        return [term for term in set(self.termDB) | set(self.pending) if self.postings(term)]
+
+    def documentStats(self, terms):
+        documents = self.metaDB.get("documents", 0)
+        average   = self.metaDB.get("length", 0) / documents if documents else 0
+        frequency = {}
+
+        for term in terms:
+            frequency[term] = sum(len(revisions) for revisions in self.postings(term).values())
+
+        return (documents, average, frequency)
+
+    def manifest(self):
+        return dict(self.manifestDB)
+
+    def setManifest(self, page, revision, mtime):
+        self.manifestDB[page] = (revision, mtime)
+
+    def candidates(self, terms):
+        ranks = collections.defaultdict(float)
+
+        for term in terms:
+            for page, revisions in self.postings(term).items():
+                ranks[page] += sum(revisions.values()) / len(revisions)
+
+        return sorted(ranks, key=ranks.get, reverse=True)
+
+    def storedGeneration(self):
+        try:
+            return int(open(self.generationFile).read())
+        except (IOError, ValueError):
+            return 0
+
+    # a plain file rather than a shelf, so other processes' commits show up
+    def generation(self):
+        if self.dirty: return self.pendingGeneration
+        return self.storedGeneration()
+
+    def touch(self):
+        if not self.dirty:
+            self.pendingGeneration = self.storedGeneration() + 1
+            self.dirty = True
+
+    def clear(self):
+        self.touch()
+        self.pending.clear()
+        self.searchDB.clear()
+        self.termDB.clear()
+        self.manifestDB.clear()
+        self.metaDB.clear()
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lockFile, "a") as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            yield
+
+    # the generation is counted on under the lock, so two processes
+    # committing at once can't both store the same one
+    def commit(self):
+        with self.locked():
+            # writeback puts back everything that was read, which would only
+            # undo other processes' commits when nothing was stored here
+            if self.dirty:  self.searchDB.sync()
+            else:           self.searchDB.cache.clear()
+
+            for term, postings in self.pending.items():
+                if postings:                self.termDB[term] = postings
+                elif term in self.termDB:   del self.termDB[term]
+
+            self.pending.clear()
+            self.termDB.sync()
+            self.manifestDB.sync()
+            self.metaDB.sync()
+
+            if not self.dirty: return
+
+            stored = self.storedGeneration()
+            fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(self.generationFile), suffix=".tmp")
+
+            with os.fdopen(fd, "w") as tmpFile:
+                tmpFile.write(str(stored + 1))
+
+            os.replace(tmpName, self.generationFile)
+
+        # a commit from elsewhere since the shelves were opened still needs
+        # them opened again, see refresh
+        if stored == self.openGeneration: self.openGeneration = stored + 1
+        self.dirty = False
+
+    def close(self):
+        self.commit()
+        self.searchDB.close()
+        self.termDB.close()
+        self.manifestDB.close()
+        self.metaDB.close()
+
+
+class SQLiteIndex(object):
+    def __init__(self, searchFile, fts=None):
+        self.db = sqlite3.connect(searchFile + ".sqlite")
+        self.db.execute("PRAGMA journal_mode=WAL")
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS revisions (
+                               page TEXT NOT NULL, revision INTEGER NOT NULL, record TEXT NOT NULL,
+                               PRIMARY KEY (page, revision))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS manifest (
+                               page TEXT PRIMARY KEY, revision INTEGER, mtime REAL NOT NULL)""")
+
+        # an existing index keeps whatever layout it was created with
+        stored = self.getMeta("fts")
+
+        if stored is not None:  fts = (stored == "1")
+        elif fts is None:       fts = ftsAvailable()
+
+        self.fts = fts
+
+        if fts:
+            self.db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS documents
+                               USING fts5(page UNINDEXED, revision UNINDEXED, body, extra)""")
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS vocabulary USING fts5vocab(documents, row)")
+        else:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS postings (
+                                   term TEXT NOT NULL, page TEXT NOT NULL, revision INTEGER NOT NULL,
+                                   count INTEGER NOT NULL, PRIMARY KEY (term, page, revision))
+                               WITHOUT ROWID""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS postings_page ON postings (page)")
+
+        self.setMeta("fts", "1" if fts else "0")
+        self.db.commit()
+
+        self.dirty = False
+
+    def getMeta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def setMeta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @staticmethod
+    def encode(record):
+        record = dict(record)
+        record["links"] = sorted(record["links"])
+        return json.dumps(record)
+
+    @staticmethod
+    def decode(data):
+        record = json.loads(data)
+        record["links"] = set(record["links"])
+        return record
+
+    def pages(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT page FROM revisions")]
+
+    def __contains__(self, page):
+        row = self.db.execute("SELECT 1 FROM revisions WHERE page = ? LIMIT 1", (page,)).fetchone()
+        return row is not None
+
+    def revisions(self, page):
+        rows = self.db.execute("SELECT revision, record FROM revisions WHERE page = ?", (page,))
+        return {revision: self.decode(record) for revision, record in rows}
+
+    def storeRevision(self, page, revision, record):
+        self.touch()
+        self.removeRevision(page, revision)
+
+        cursor = self.db.execute("INSERT INTO revisions (page, revision, record) VALUES (?, ?, ?)",
+                                 (page, revision, self.encode(record)))
+
+        if self.fts:
+            body  = []
+            for word, count in record["words"].items(): body += [word] * count
+
+            extra = record["titleWords"] + record["linkWords"]
+
+            # documents share their rowid with revisions, so removal never has
+            # to scan the unindexed page column
+            self.db.execute("INSERT INTO documents (rowid, page, revision, body, extra) VALUES (?, ?, ?, ?, ?)",
+                            (cursor.lastrowid, page, revision, " ".join(body), " ".join(extra)))
+        else:
+            self.db.executemany("INSERT INTO postings (term, page, revision, count) VALUES (?, ?, ?, ?)",
+                                [(term, page, revision, count)
+                                 for term, count in recordTerms(record).items()])
+
+    def removeRevision(self, page, revision):
+        self.removeRows("page = ? AND revision = ?", (page, revision))
+
+    def removePage(self, page):
+        self.touch()
+        self.removeRows("page = ?", (page,))
+        self.db.execute("DELETE FROM manifest WHERE page = ?", (page,))
+
+    def removeRows(self, where, params):
+        if self.fts:
+            self.db.execute("DELETE FROM documents WHERE rowid IN (SELECT rowid FROM revisions WHERE {})".format(where),
+                            params)
+        else:
+            self.db.execute("DELETE FROM postings WHERE {}".format(where), params)
+
+        self.db.execute("DELETE FROM revisions WHERE {}".format(where), params)
+
+    def candidates(self, terms):
+        if not terms: return []
+
+        if self.fts:
+            match = " OR ".join("\"{}\"".format(term) for term in terms)
+            rows  = self.db.execute("""SELECT page FROM documents WHERE documents MATCH ?
+                                       ORDER BY bm25(documents, 0.0, 0.0, 1.0, 2.0)""", (match,))
+        else:
+            marks = ", ".join("?" * len(terms))
+            rows  = self.db.execute("""SELECT page FROM postings WHERE term IN ({})
+                                       GROUP BY page ORDER BY SUM(count) DESC""".format(marks), list(terms))
+
+        ret, seen = [], set()
+
+        for (page,) in rows:
+            if page not in seen:
+                seen.add(page)
+                ret.append(page)
+
+        return ret
+
+    def terms(self):
+        if self.fts:    rows = self.db.execute("SELECT term FROM vocabulary")
+        else:           rows = self.db.execute("SELECT DISTINCT term FROM postings")
+
+        return [row[0] for row in rows]
+
+    def documentStats(self, terms):
+        documents, average = self.db.execute("""SELECT COUNT(*), AVG(json_extract(record, '$.length'))
+                                                FROM revisions""").fetchone()
+        frequency = dict.fromkeys(terms, 0)
+
+        if terms:
+            marks = ", ".join("?" * len(terms))
+
+            if self.fts:
+                rows = self.db.execute("SELECT term, doc FROM vocabulary WHERE term IN ({})".format(marks),
+                                       list(terms))
+            else:
+                rows = self.db.execute("""SELECT term, COUNT(*) FROM postings WHERE term IN ({})
+                                          GROUP BY term""".format(marks), list(terms))
+
+            frequency.update(rows)
+
+        return (documents, average or 0, frequency)
+
+    def manifest(self):
+        rows = self.db.execute("SELECT page, revision, mtime FROM manifest")
+        return {page: (revision, mtime) for page, revision, mtime in rows}
+
+    def setManifest(self, page, revision, mtime):
+        self.db.execute("INSERT OR REPLACE INTO manifest (page, revision, mtime) VALUES (?, ?, ?)",
+                        (page, revision, mtime))
+
+    def generation(self):
+        return int(self.getMeta("generation") or 0)
+
+    def touch(self):
+        if not self.dirty:
+            # read and bumped in one statement, which holds the write lock
+            self.db.execute("""INSERT OR REPLACE INTO meta (key, value)
+                               SELECT 'generation', COALESCE(CAST(value AS INTEGER), 0) + 1
+                               FROM (SELECT 1) LEFT JOIN meta ON key = 'generation'""")
+            self.dirty = True
+
+    def clear(self):
+        self.touch()
+        self.db.execute("DELETE FROM manifest")
+        self.db.execute("DELETE FROM revisions")
+        self.db.execute("DELETE FROM {}".format("documents" if self.fts else "postings"))
+
+    # every query reads what's committed, nothing to reopen
+    def refresh(self):
+        pass
+
+    def commit(self):
+        self.db.commit()
+        self.dirty = False
+
+    def close(self):
+        self.db.close()
+
+
+BACKENDS = {
+    "shelve": ShelveIndex,
+    "sqlite": SQLiteIndex,
+}
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import os
+import bisect
+import collections
+import pickle
+import tempfile
+
+# a wildcard never expands to more terms than this
+MAXEXPANSION = 64
+
+def trigrams(word):
+    return {word[i:i+3] for i in range(len(word) - 2)}
+
+
+# every term in the search index, sorted for prefix lookups by bisection,
+# plus trigram -> term postings for substrings; tagged with the index
+# generation it was built from
+class TermDictionary(object):
+    def __init__(self, terms=(), generation=None):
+        self.terms      = sorted(set(terms))
+        self.generation = generation
+        self.grams      = collections.defaultdict(list)
+
+        for i, term in enumerate(self.terms):
+            for gram in trigrams(term):
+                self.grams[gram].append(i)
+
+    def prefix(self, prefix, limit=MAXEXPANSION):
+        ret = []
+        i   = bisect.bisect_left(self.terms, prefix)
+
+        while i < len(self.terms) and len(ret) < limit and self.terms[i].startswith(prefix):
+            ret.append(self.terms[i])
+            i += 1
+
+        return ret
+
+    def substring(self, infix, limit=MAXEXPANSION, suffix=False):
+        if len(infix) < 3:
+            candidates = self.terms
+        else:
+            # intersect starting from the rarest trigram
+            postings = sorted((self.grams.get(gram, ()) for gram in trigrams(infix)), key=len)
+            ids      = set(postings[0])
+
+            for posting in postings[1:]:
+                if not ids: break
+                ids.intersection_update(posting)
+
+            candidates = [self.terms[i] for i in sorted(ids)]
+
+        ret = []
+
+        for term in candidates:
+            if (term.endswith(infix) if suffix else infix in term):
+                ret.append(term)
+                if len(ret) >= limit: break
+
+        return ret
+
+    def save(self, filename):
+        fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as tmpFile:
+            pickle.dump((self.generation, self.terms, dict(self.grams)), tmpFile, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmpName, filename)
+
+    @classmethod
+    def load(cls, filename):
+        try:
+            generation, terms, grams = pickle.load(open(filename, "rb"))
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+
+        ret = cls(generation=generation)
+        ret.terms = terms
+        ret.grams.update(grams)
+        return ret
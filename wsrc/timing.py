@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+import sys, os
+import collections
+import contextlib
+import json
+import time
+
+# off unless WIKI_TIMING is set; spans and counters are then a function
+# call that does nothing
+ENABLED     = bool(os.environ.get("WIKI_TIMING"))
+LOGFILE     = os.environ.get("WIKI_TIMING_LOG", "timing.log")
+RECENT      = 1000
+
+NULLSPAN    = contextlib.nullcontext()
+
+spans       = collections.OrderedDict()     # name -> seconds this request
+counters    = collections.OrderedDict()     # name -> count this request
+
+def reset():
+    spans.clear()
+    counters.clear()
+
+@contextlib.contextmanager
+def timedSpan(name):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        spans[name] = spans.get(name, 0.0) + time.perf_counter() - start
+
+def span(name):
+    if not ENABLED: return NULLSPAN
+    return timedSpan(name)
+
+def count(name, amount=1):
+    if ENABLED: counters[name] = counters.get(name, 0) + amount
+
+def serverTiming():
+    ret = ["{0};dur={1:.2f}".format(name, seconds * 1000) for name, seconds in spans.items()]
+    ret += ["{0};desc={1}".format(name, value) for name, value in counters.items()]
+
+    return ", ".join(ret)
+
+def logRequest(**fields):
+    if not ENABLED: return
+
+    record = dict(fields)
+    record["time"]     = round(time.time(), 3)
+    record["spans"]    = {name: round(seconds * 1000, 3) for name, seconds in spans.items()}
+    record["counters"] = dict(counters)
+
+    line = json.dumps(record, sort_keys=True)
+    print(line, file=sys.stderr)
+
+    try:
+        with open(LOGFILE, "a") as logFile:
+            logFile.write(line + "\n")
+    except IOError:
+        pass
+
+def recentRequests(limit=RECENT):
+    try:
+        lines = collections.deque(open(LOGFILE), limit)
+    except IOError:
+        return []
+
+    ret = []
+
+    for line in lines:
+        try:
+            ret.append(json.loads(line))
+        except ValueError:
+            continue
+
+    return ret
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# span name -> (requests, p50, p90, p99) in milliseconds
+def summarize(requests):
+    samples = collections.defaultdict(list)
+
+    for request in requests:
+        for name, millis in request.get("spans", {}).items():
+            samples[name].append(millis)
+
+    ret = collections.OrderedDict()
+
+    for name in sorted(samples):
+        values = sorted(samples[name])
+        ret[name] = (len(values), percentile(values, 0.5), percentile(values, 0.9), percentile(values, 0.99))
+
+    return ret
@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+import os, shutil
+import collections
+import hashlib
+import json
+import tempfile
+
+from . import wikiformat
+
+# anything whose source changes the rendered output goes here
+VERSIONED = (wikiformat,)
+
+def formatterVersion():
+    digest = hashlib.sha1()
+
+    for module in VERSIONED:
+        digest.update(open(module.__file__, "rb").read())
+
+    return digest.hexdigest()[:16]
+
+
+# entries are {"html", "links", "missing"}: the rendered page, the internal
+# links in it and the ones that were rendered as missing, so callers can
+# tell when a page appearing or going away makes an entry stale
+class RenderCache(object):
+    def __init__(self, cacheDir="renderCache", maxEntries=256, version=None):
+        if version is None: version = formatterVersion()
+
+        self.cacheDir   = os.path.abspath(cacheDir)
+        self.version    = version
+        self.versionDir = self.cacheDir + os.sep + version
+        self.maxEntries = maxEntries
+        self.entries    = collections.OrderedDict()
+
+    @staticmethod
+    def key(page, revision):
+        return "{0}_{1}".format(page, revision)
+
+    def get(self, page, revision):
+        key = self.key(page, revision)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        try:
+            entry = json.load(open(self.versionDir + os.sep + key + ".json", encoding="utf-8"))
+        except (IOError, ValueError):
+            return None
+
+        self.remember(key, entry)
+        return entry
+
+    def put(self, page, revision, entry):
+        key = self.key(page, revision)
+        self.remember(key, entry)
+
+        # the disk tier is best-effort, a failed write just means a re-render
+        try:
+            if not os.path.isdir(self.versionDir):
+                os.makedirs(self.versionDir)
+                self.purgeStale()
+
+            fd, tmpName = tempfile.mkstemp(dir=self.versionDir, suffix=".tmp")
+
+            with os.fdopen(fd, "w", encoding="utf-8") as tmpFile:
+                json.dump(entry, tmpFile)
+
+            os.replace(tmpName, self.versionDir + os.sep + key + ".json")
+
+        except OSError:
+            pass
+
+    def remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    def purgeStale(self):
+        for version in os.listdir(self.cacheDir):
+            if version != self.version:
+                shutil.rmtree(self.cacheDir + os.sep + version, ignore_errors=True)
+
@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+import os
+import io
+import itertools
+import json
+import tarfile
+import time
+
+from . import post, revstore, wikipage, catalog, linkgraph
+
+# a dump is a stream of {"page", "time", "text", "metadata"} records, a
+# page's revisions together and oldest first; "time" is in
+# revstore.TIMEFORMAT, and "metadata" (optional) goes with the page
+FORMATS     = ("jsonl", "tar")
+METAMEMBER  = "metadata.json"
+
+def guessFormat(filename):
+    if filename.endswith((".tar", ".tar.gz", ".tgz")): return "tar"
+    return "jsonl"
+
+def iterRecords(pageDir="pages", pages=None):
+    if pages is None:
+        pages = sorted(page for page in os.listdir(pageDir) if os.path.isdir(pageDir + os.sep + page))
+
+    for page in pages:
+        try:
+            wikiPage = wikipage.WikiPage(page, pageDir)
+        except ValueError:
+            continue
+
+        metadata = dict(wikiPage.metadata)
+
+        for revision in sorted(wikiPage.revisions):
+            try:
+                wanted = wikiPage.get(revision)
+            except TypeError:
+                continue
+
+            # unparseable, loadRevision moved it out of the way
+            if revision not in wikiPage.revisions: continue
+
+            record = {"page": wikiPage.pageName, "time": revstore.formatTime(revision), "text": wanted["page"]}
+
+            if metadata:
+                record["metadata"] = metadata
+                metadata = None
+
+            yield record
+
+def writeJSONL(records, outFile):
+    count = 0
+
+    for record in records:
+        outFile.write(json.dumps(record, sort_keys=True) + "\n")
+        count += 1
+
+    return count
+
+def readJSONL(inFile):
+    for line in inFile:
+        if line.strip(): yield json.loads(line)
+
+def writeTar(records, outFile, compress=False):
+    count = 0
+
+    def addMember(name, data, mtime):
+        info       = tarfile.TarInfo(name)
+        info.size  = len(data)
+        info.mtime = mtime
+        tar.addfile(info, io.BytesIO(data))
+
+    with tarfile.open(fileobj=outFile, mode="w|gz" if compress else "w|") as tar:
+        for record in records:
+            mtime = revstore.epochTime(revstore.parseTime(record["time"]))
+
+            if "metadata" in record:
+                addMember(record["page"] + "/" + METAMEMBER,
+                          json.dumps(record["metadata"], sort_keys=True).encode("utf-8"), mtime)
+
+            addMember("{0}/{1}.txt".format(record["page"], record["time"]), record["text"].encode("utf-8"), mtime)
+            count += 1
+
+    return count
+
+def readTar(inFile):
+    with tarfile.open(fileobj=inFile, mode="r|*") as tar:
+        for member in tar:
+            if not member.isfile(): continue
+
+            page, _, name = member.name.strip("/").rpartition("/")
+            data          = tar.extractfile(member).read().decode("utf-8")
+
+            if name == METAMEMBER:
+                yield {"page": page, "metadata": json.loads(data)}
+            elif name.endswith(".txt"):
+                yield {"page": page, "time": name[:-len(".txt")], "text": data}
+
+# writes one run of records for a page straight into its store, without
+# the catalog, link graph and search updates addRevision does every time;
+# revisions the page already has are skipped, so a dump can be loaded twice
+def importPage(page, records, pageDir="pages", kind=wikipage.DEFAULTSTORE, cutoff=50):
+    wikiPage = wikipage.WikiPage(page, pageDir)
+    metadata = {}
+    texts    = {}
+
+    for record in records:
+        metadata.update(record.get("metadata") or {})
+        if "text" not in record: continue
+
+        if "time" in record:
+            revision = revstore.parseTime(record["time"])
+        else:
+            revision = revstore.parseTime(time.strftime(revstore.TIMEFORMAT, time.gmtime()))
+
+        raw = post.Post("irrelevant", fields={"page": record["text"]}).rawNoHeader
+
+        # only a different text under the same timestamp moves it along
+        while revision in texts or revision in wikiPage.revisions:
+            if revision in wikiPage.revisions and wikiPage.store.read(revision) == raw: break
+            revision += 1
+        else:
+            texts[revision] = raw
+
+    wikiPage.create()
+
+    if texts:
+        if not wikiPage.exists: wikiPage.store = revstore.STORES[kind](wikiPage.postDir)
+        wikiPage.store.writeMany(texts)
+
+    if metadata or not os.path.isfile(wikiPage.metaFile):
+        wikiPage.metadata.update(metadata)
+        wikiPage.writeMetadata()
+
+    wikiPage.updateRevisions()
+    wikiPage.purgeOldest(cutoff)
+
+    return wikiPage, len(texts)
+
+# -> ({page: revisions imported}, records skipped); the catalog and link
+# graph get one write for the whole batch, the search index is up to the
+# caller, see WikiSearcher.syncPages
+def importRecords(records, pageDir="pages", kind=wikipage.DEFAULTSTORE, cutoff=50, debug=False):
+    pageCatalog = catalog.getCatalog(pageDir)
+    rebuild     = pageCatalog.existing() is None
+
+    imported = {}
+    entries  = {}
+    links    = {}
+    skipped  = 0
+
+    for page, group in itertools.groupby(records, key=(lambda record: record.get("page", ""))):
+        group = list(group)
+
+        try:
+            wikiPage, count = importPage(page, group, pageDir, kind, cutoff)
+        except ValueError as e:
+            if debug: print("{0}: {1}, skipped".format(page, e))
+            skipped += len(group)
+            continue
+
+        if debug: print("{0}: {1} revisions".format(wikiPage.pageName, count))
+
+        imported[wikiPage.pageName] = imported.get(wikiPage.pageName, 0) + count
+        entries[wikiPage.pageName]  = wikiPage.catalogEntry()
+        links[wikiPage.pageName]    = wikiPage.currentLinks()
+
+    if rebuild:
+        wikipage.rebuildCatalog(pageDir)
+    else:
+        pageCatalog.update(entries)
+        linkgraph.getLinkGraph(pageDir).update(links)
+
+    return imported, skipped
@@ -4,6 +4,8 @@ import os, sys, shutil
 import string, re
 import time
 import cgi
+import collections
+import functools
 
 from . import post
 
@@ -39,6 +41,7 @@ URLRE = r"""(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]
 
 LINK1       = "<a href=\"?page={0}\">{1}</a>"
 LINK2       = "<a href=\"{0}\" class=\"wikiExternal\">{1}</a>"
+LINK3       = "<a href=\"?page={0}\" class=\"wikiMissing\">{1}</a>"
 
 LETTERS     = string.ascii_letters
 UPPER       = string.ascii_uppercase
@@ -77,8 +80,149 @@ SUBFORMATRE_PARTS = \
 SUBFORMAT   = "({})".format(")|(".join(SUBFORMATRE_PARTS))
 SUBFORMATRE = re.compile(SUBFORMAT)
 
+# SUBFORMATRE can only ever match starting on one of "[{A-Z", so runs of
+# anything else are eaten whole instead of retrying every alternative at
+# every character; those runs come back with no lastindex
+TOKENRE     = re.compile(SUBFORMAT + "|[^\\[{A-Z]+|.")
+
+# URLRE with the runs inside its repeated groups taken one character at a
+# time: the same URLs match, but an unterminated [[url no longer sends it
+# into exponential backtracking
+URLRE_LINEAR= URLRE.replace("[^\s()<>]+|", "[^\s()<>]|")
+
+# EXPLICITRE1-3 and NOLINKRE/BRACECLASSRE folded into one match each; the
+# alternatives are tried in the same order the old checks ran in
+URLGROUPS   = re.compile(URLRE_LINEAR).groups
+BRACKETRE   = re.compile("\[\[(?:" + VALIDRE3 + "\]\]|" + VALIDRE3 + " (.+?)\]\]|" + URLRE_LINEAR + " (.+?)\]\])")
+BRACKETTEXT = 4 + URLGROUPS
+BRACERE     = re.compile("\{\{(?:" + VALIDRE3 + "\}\}$|([a-zA-Z]+):(.+?)\}\})")
+
+TAGRE       = re.compile("<[^<]+?>")
+WORDRE      = re.compile("([a-zA-Z0-9]+(?:'[a-zA-Z0-9]*)?)")
+
 CODESTART = "  "
 
+# line nodes
+CODE, BLANK, LINE = range(3)
+
+# inline nodes
+TEXT, PAGELINK, NAMEDLINK, URLLINK, NESTED, NOLINK, BRACECLASS, CAMELCASE = range(8)
+
+def parseContents(contents):
+    return [parseLine(line) for line in contents.split("\n")]
+
+def parseLine(line):
+    if line.startswith(CODESTART):
+        return (CODE, line[len(CODESTART):])
+
+    if not line.strip():
+        return (BLANK, None)
+
+    return (LINE, parseInline(" " + line + " "))
+
+def parseInline(text):
+    nodes = []
+    pos = 0
+
+    for match in TOKENRE.finditer(text):
+        which = match.lastindex
+        if which is None: continue
+
+        start = match.start()
+
+        if start > pos:
+            nodes.append((TEXT, text[pos:start]))
+
+        pos = match.end()
+        group = match.group(which)
+
+        if which == 3:
+            # LINKRE only stops short of the whole word when it ends in a
+            # dash, and whatever it leaves out is dropped
+            if group[-1] != "-":
+                nodes.append((CAMELCASE, group))
+            else:
+                implicit = LINKRE.match(group)
+                if implicit: nodes.append((CAMELCASE, implicit.group(1)))
+
+        elif which == 1:
+            explicit = BRACKETRE.match(group)
+
+            if explicit is None:
+                nodes.append((NESTED, " [[", parseLine(group[2:-2]), "]] "))
+            elif explicit.group(1) is not None:
+                nodes.append((PAGELINK, explicit.group(1)))
+            elif explicit.group(2) is not None:
+                nodes.append((NAMEDLINK, explicit.group(2), explicit.group(3)))
+            else:
+                nodes.append((URLLINK, explicit.group(4), explicit.group(BRACKETTEXT)))
+
+        else:
+            explicit = BRACERE.match(group)
+
+            if explicit is None:
+                nodes.append((NESTED, " {{", parseLine(group[2:-2]), "}} "))
+            elif explicit.group(1) is not None:
+                nodes.append((NOLINK, explicit.group(1)))
+            else:
+                contents = [i.rstrip() for i in explicit.group(3).split("|")]
+                data     = [parseLine(i) for i in contents[1:]]
+                nodes.append((BRACECLASS, explicit.group(2).lower(), group, contents[0], data))
+
+    if pos < len(text):
+        nodes.append((TEXT, text[pos:]))
+
+    return nodes
+
+
+# nicify works on character classes: P(unctuation), U(pper), L(ower), D(igit)
+# and O(ther); a space goes in front of a character depending on its class
+# and those of its neighbours (the ends count as uppercase)
+class CharClasses(dict):
+    def __missing__(self, key):
+        return "O"
+
+CHARCLASSES = CharClasses(str.maketrans(PUNCTUATION + UPPER + LOWER + DIGITS,
+                                        "P" * len(PUNCTUATION) + "U" * len(UPPER) +
+                                        "L" * len(LOWER) + "D" * len(DIGITS)))
+
+def spaceBefore(lastChar, char, nextChar):
+    if char == "P":
+        return lastChar != "P"
+
+    if char == "U":
+        return lastChar != "U" or nextChar == "L"
+
+    if char == "D":
+        return lastChar == "L" and nextChar != "L"
+
+    return False
+
+SPACEBEFORE = {lastChar + char + nextChar for lastChar in "PULDO"
+                                          for char     in "PULDO"
+                                          for nextChar in "PULDO"
+                                          if spaceBefore(lastChar, char, nextChar)}
+
+INVALIDRE   = re.compile(INVALID)
+NICECACHE   = 4096
+
+@functools.lru_cache(maxsize=NICECACHE)
+def nicify(title):
+    classes = "U" + title.translate(CHARCLASSES) + "U"
+    ret = []
+
+    for i, char in enumerate(title):
+        if classes[i:i+3] in SPACEBEFORE: ret.append(" ")
+        ret.append(char)
+
+    return "".join(ret).strip()
+
+@functools.lru_cache(maxsize=NICECACHE)
+def unnicify(title):
+    # every kept character comes out uppercased, as it always has
+    return INVALIDRE.sub("", title).upper()
+
+
 class WikiFormatter(object):
     BraceClasses = {
         "image":        "<img src=\"{data[0]}\" />",
@@ -89,74 +233,196 @@ class WikiFormatter(object):
         "captionright": "<div class=\"floatRight\"><img src=\"{data[0]}\" /><br />{data[1]}</div>",
     }
     
-    def __init__(self):
-        self.subformatters  = (self.bracketFormat, self.braceFormat, self.linkFormat)
+    # existing is a set of lowercased page names; links to anything else
+    # render as wikiMissing, unless it's None
+    def __init__(self, existing=None):
         self.braceClasses   = self.__class__.BraceClasses
-    
-    @staticmethod
-    def nicify(title):
-        def addchars(chars, char=None):
-            nonlocal ret, lastChar
-            ret += chars
-            if char is None:    lastChar = chars
-            else:               lastChar = char
-
-        ret = ""
-        lastChar = "A"
-
-        for i in range(len(title)):
-            lastChar    = "A" if (i == 0) else title[i-1]
-            char        = title[i]
-            nextChar    = "A" if (i == (len(title) - 1)) else title[i+1]
-
-            if char in PUNCTUATION:
-                if lastChar not in PUNCTUATION:
-                    addchars(" " + char, char)
-                    continue
-
-            if char in UPPER:
-                if lastChar not in UPPER:
-                    addchars(" " + char, char)
-                    continue
-
-                if lastChar in UPPER and nextChar in LOWER:
-                    addchars(" " + char, char)
-                    continue
-
-            if char in DIGITS:
-                if lastChar in LOWER and nextChar in LOWER:
-                    addchars(char)
-                    continue
-
-                if lastChar in LOWER:
-                    addchars(" " + char, char)
-                    continue
-
-            addchars(char)
-        
-        return ret.strip()
+        self.existing       = existing
+
+    def pageLink(self, page, text):
+        if self.existing is None or page.lower() in self.existing:
+            return LINK1.format(page, text)
+
+        return LINK3.format(page, text)
+
+    nicify      = staticmethod(nicify)
+    unnicify    = staticmethod(unnicify)
+
+    def formatContents(self, contents, escaped=False, withLinks=False):
+        links = {"internal": set(), "external": set()}
+        ret   = "".join(self.iterContents(contents, links, escaped))
 
-    @staticmethod
-    def unnicify(title):
+        if withLinks:
+            return (ret, links)
+
+        return ret
+
+    # the same output as formatContents a line at a time, so a large page
+    # can go out before all of it is formatted; links fill in as it runs
+    def iterContents(self, contents, links, escaped=False):
+        if not escaped:
+            contents = cgi.escape(contents)
+            contents = contents.replace("&amp;#45;", "-")
+
+        inCode = False
+        sep = ""
+
+        for kind, value in parseContents(contents):
+            if kind == CODE:
+                retadd = value if inCode else "<div class=\"wikiSource\">" + value
+                inCode = True
+
+            elif kind == BLANK:
+                retadd = "\n"
+
+            else:
+                retadd = "</div>" if inCode else ""
+                retadd += self.renderLine(value, links) + "\n"
+                inCode = False
+
+            yield sep + retadd
+            sep = "<br />"
+
+        if inCode:
+            yield "</div>"
+
+    def renderLine(self, nodes, links):
+        renderNode = self.renderNode
+        line = "".join([node[1] if node[0] == TEXT else renderNode(node, links) for node in nodes])
+
+        if "''" in line:
+            line = ITALICRE.sub("<em>\g<1></em>", line)
+            line = BOLDRE.sub("<strong>\g<1></strong>", line)
+
+        return line[1:-1]
+
+    def renderNested(self, lineNode, links):
+        kind, value = lineNode
+
+        if kind == CODE:    return "<div class=\"wikiSource\">" + value + "</div>"
+        if kind == BLANK:   return ""
+
+        return self.renderLine(value, links).rstrip()
+
+    def renderNode(self, node, links):
+        kind = node[0]
+
+        if kind == TEXT:
+            return node[1]
+
+        if kind == PAGELINK:
+            links['internal'].add(node[1])
+            return self.pageLink(node[1], self.nicify(node[1]))
+
+        if kind == NAMEDLINK:
+            links['internal'].add(node[1])
+            return self.pageLink(node[1], node[2])
+
+        if kind == URLLINK:
+            links['external'].add(node[1])
+            return LINK2.format(node[1], node[2])
+
+        if kind == CAMELCASE:
+            links['internal'].add(node[1])
+            return self.pageLink(node[1], self.nicify(node[1]))
+
+        if kind == NOLINK:
+            return node[1]
+
+        if kind == NESTED:
+            return node[1] + self.renderNested(node[2], links) + node[3]
+
+        if kind == BRACECLASS:
+            kind, cls, group, first, data = node
+
+            contents  = [first] + [self.renderNested(i, links) for i in data]
+            contents += ([""] * 10)   # ugly hack gooooooo
+
+            return self.braceClasses.get(cls, group).format(data=contents)
+
+    def analyzeContents(self, contents):
+        links = {"internal": set(), "external": set()}
+        words = collections.defaultdict(int)
+        contents = contents.replace("&#45;", "-")
+
+        for word in self.plainContents(contents, links).lower().split():
+            word = WORDRE.search(word)
+            if not word: continue
+
+            words[word.group(1)] += 1
+
+        return (dict(words), links)
+
+    def plainContents(self, contents, links):
         ret = []
 
-        upperNext = True
+        for kind, value in parseContents(contents):
+            if kind == CODE:
+                ret.append(value)
+
+            elif kind == LINE:
+                ret.append(self.plainLine(value, links))
+
+        return "\n".join(ret)
+
+    def plainLine(self, nodes, links):
+        line = "".join([self.plainNode(node, links) for node in nodes])
+
+        if "''" in line:
+            line = ITALICRE.sub("\g<1>", line)
+            line = BOLDRE.sub("\g<1>", line)
+
+        return line[1:-1]
 
-        for char in title:
-            if char in " \t":
-                upperNext = True
-                continue
+    def plainNested(self, lineNode, links):
+        kind, value = lineNode
 
-            if char not in VALID:
-                continue
+        if kind == CODE:    return value
+        if kind == BLANK:   return ""
 
-            if upperNext:
-                ret.append(char.upper())
-                continue
+        return self.plainLine(value, links)
 
-            ret.append(char)
+    def plainNode(self, node, links):
+        kind = node[0]
 
-        return "".join(ret)
+        if kind == TEXT or kind == NOLINK:
+            return node[1]
+
+        if kind == PAGELINK or kind == CAMELCASE:
+            links['internal'].add(node[1])
+            return self.nicify(node[1])
+
+        if kind == NAMEDLINK:
+            links['internal'].add(node[1])
+            return node[2]
+
+        if kind == URLLINK:
+            links['external'].add(node[1])
+            return node[2]
+
+        if kind == NESTED:
+            return node[1] + self.plainNested(node[2], links) + node[3]
+
+        if kind == BRACECLASS:
+            kind, cls, group, first, data = node
+
+            if cls not in self.braceClasses:
+                return group[1:-1]
+
+            contents  = [first] + [self.plainNested(i, links) for i in data]
+            contents += ([""] * 10)
+
+            # only the text the brace class would show counts, not its markup
+            return TAGRE.sub("", self.braceClasses[cls].format(data=contents))
+
+
+class LegacyFormatter(WikiFormatter):
+    # the per-line regex formatter WikiFormatter replaced; checkFormat.py
+    # compares the two
+
+    def __init__(self):
+        super().__init__()
+        self.subformatters  = (self.bracketFormat, self.braceFormat, self.linkFormat)
 
     def formatContents(self, contents, escaped=False, withLinks=False):
         links = {"internal": set(), "external": set()}
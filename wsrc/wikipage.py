@@ -1,12 +1,13 @@
 #!/usr/bin/python3
 
 import os, sys, shutil
-import collections
-import string, re
+import string
 import time
 import cgi
+import hashlib
+import json
 
-from . import post, wikiformat
+from . import post, wikiformat, wikicache, revstore, catalog, linkgraph, timing
 
 TIMEFORMAT  = "%Y-%m-%d_%H:%M:%S"
 TIMEFORMAT2 = "%Y-%m-%d %H:%M:%S"
@@ -23,14 +24,29 @@ UPPERDIGITS = string.ascii_uppercase + string.digits
 PUNCTUATION = "_-"
 VALID       = LETTERS + DIGITS + PUNCTUATION
 
-NOTAGRE     = re.compile("<[^<]+?>")
-WORDRE      = re.compile("([a-zA-Z0-9]+(?:'[a-zA-Z0-9]*)?)")
+WORDRE      = wikiformat.WORDRE
 
-inner = open("wikiInner.html").read()
-inner = string.Template(inner)
+# how new pages keep their history, see revstore.STORES
+DEFAULTSTORE = "loose"
 
-addInner = open("wikiAdd.html").read()
-addInner = string.Template(addInner)
+# cut around the content so the text before it can be sent while the
+# page is still being formatted
+def splitTemplate(text, name):
+    head, found, tail = text.partition("${" + name + "}")
+    if not found: raise ValueError("template has no ${{{0}}}".format(name))
+
+    return string.Template(head), string.Template(tail)
+
+innerText = open("wikiInner.html").read()
+addText   = open("wikiAdd.html").read()
+
+inner    = splitTemplate(innerText, "content")
+addInner = splitTemplate(addText, "content")
+
+formatter = wikiformat.WikiFormatter()
+renderCache = wikicache.RenderCache()
+
+TEMPLATEVERSION = hashlib.sha1((renderCache.version + innerText + addText).encode("utf-8")).hexdigest()[:16]
 
 
 class WikiPage(object):
@@ -38,8 +54,10 @@ class WikiPage(object):
 
         postdir = os.path.abspath(postdir)
 
-        self.formatter  = wikiformat.WikiFormatter()
+        self.formatter  = formatter
         self.revisions  = {}
+        self.catalog    = catalog.getCatalog(postdir)
+        self.linkGraph  = linkgraph.getLinkGraph(postdir)
 
         if not os.path.isdir(postdir): raise IOError("{0} is not a directory".format(postdir))
 
@@ -54,11 +72,12 @@ class WikiPage(object):
         self.postDir    = postdir + os.sep + self.pageName
         self.metaFile   = self.postDir + os.sep + "metadata.txt"
 
-        if not os.path.isdir(self.postDir):
-            if os.path.exists(self.postDir):
-                raise IOError("{0} exists and is not a directory".format(self.postDir))
-            else:
-                os.mkdir(self.postDir)
+        if os.path.exists(self.postDir) and not os.path.isdir(self.postDir):
+            raise IOError("{0} exists and is not a directory".format(self.postDir))
+
+        # looking a page up never touches the disk; the directory only
+        # shows up once something is saved, see create
+        self.store      = revstore.openStore(self.postDir, DEFAULTSTORE)
 
         self.updateMetadata()
         self.updateRevisions()
@@ -82,6 +101,10 @@ class WikiPage(object):
     def niceName(self):
         return self.formatter.nicify(self.title)
 
+    @property
+    def exists(self):
+        return bool(self.revisions)
+
     @property
     def displayTitle(self):
         return self.metadata.get("title", self.niceName)
@@ -94,12 +117,24 @@ class WikiPage(object):
         if not os.path.isfile(self.metaFile):
             return None
 
-        metaLines = open(self.metaFile).read().splitlines()
-        metadataPost = post.parsePost("metadata", metaLines)
+        with timing.span("metadata"):
+            metaLines = open(self.metaFile).read().splitlines()
+            metadataPost = post.parsePost("metadata", metaLines)
+
+        timing.count("files")
 
         return metadataPost
         
+    def create(self):
+        if not os.path.isdir(self.postDir):
+            os.mkdir(self.postDir)
+
     def commitMetadata(self):
+        self.writeMetadata()
+        self.updateCatalog()
+
+    def writeMetadata(self):
+        self.create()
         metaCommit = post.Post("metadata")
 
         for val in self.metadata:
@@ -116,53 +151,92 @@ class WikiPage(object):
                 self.metadata[val] = meta[val]
         else:
             self.metadata["title"] = self.niceName
-            self.commitMetadata()
 
     def updateRevisions(self):
         self.revisions = {}
 
-        for revision in os.listdir(self.postDir):
-            absRev = self.postDir + os.sep + revision
+        if not os.path.isdir(self.postDir): return 0
 
-            try:
-                revTime = revision.split(".")[0]
-                revTime = time.strptime(revTime, TIMEFORMAT)
-                revTime = int(time.mktime(revTime))
-            except ValueError:
-                continue
+        # parsed on first access, see loadRevision
+        with timing.span("revisionList"):
+            for revTime in self.store.revisions():
+                self.revisions[revTime] = None
 
-            revLines = open(absRev).read().splitlines()
+        return len(self.revisions)
 
-            try:
-                self.revisions[revTime] = post.parsePost(str(revTime), revLines)
-            except (ValueError, SyntaxError):
-                newRev = list(absRev.partition("."))
-                newRev[0] += "~"
-                newRev = "".join(newRev)
+    def loadRevision(self, revision):
+        timing.count("files")
 
-                shutil.move(absRev, newRev)   # make the check fail from now on
-                continue
+        try:
+            with timing.span("revision"):
+                revLines = self.store.read(revision).splitlines()
+                self.revisions[revision] = post.parsePost(str(revision), revLines)
+        except (ValueError, SyntaxError):
+            self.store.discard(revision)   # make the check fail from now on
 
-        return len(self.revisions)
+            del self.revisions[revision]
+            return None
+
+        return self.revisions[revision]
 
     def purgeOldest(self, cutoff=50):
-        for revision in self.revisionList[cutoff:]:
-            fileTime = time.gmtime(revision)
-            fileTime = time.strftime(TIMEFORMAT, fileTime)
+        oldest = self.revisionList[cutoff:]
+        if not oldest: return
 
-            os.remove(self.postDir + os.sep + fileTime + ".txt")
+        self.store.remove(set(oldest))
+
+        for revision in oldest:
+            del self.revisions[revision]
 
     def addRevision(self, newRevision):
         curTime = time.strftime(TIMEFORMAT, time.gmtime())
 
-        newRev = open(self.postDir + os.sep + curTime + ".txt", "w")
-        newRev.write(newRevision.rawNoHeader)
-        newRev.close()
+        self.create()
+        revision = self.store.write(revstore.parseTime(curTime), newRevision.rawNoHeader)
+
+        if not os.path.isfile(self.metaFile): self.commitMetadata()
 
         self.updateRevisions()
         self.purgeOldest()
+        self.updateCatalog()
+        self.updateLinks()
+
+        return revision
+
+    # drops a directory with no history and at most metadata in it
+    def pruneEmpty(self):
+        if self.exists or set(os.listdir(self.postDir)) - {"metadata.txt", revstore.LOGLOCK}: return False
+
+        shutil.rmtree(self.postDir)
+        return True
+
+    def catalogEntry(self):
+        if not self.revisions:
+            latest, size = None, 0
+        else:
+            latest = self.revisionList[0]
+            size   = len(self.getPage(latest))
+
+        return {"title":     self.displayTitle,
+                "latest":    latest,
+                "revisions": len(self.revisions),
+                "size":      size}
+
+    def updateCatalog(self):
+        # the first save on a wiki from before the catalog builds all of it
+        if self.catalog.existing() is None:
+            rebuildCatalog(os.path.dirname(self.postDir))
+            return
+
+        self.catalog.update({self.pageName: self.catalogEntry()})
+
+    def currentLinks(self):
+        if not self.revisions: return set()
+
+        return {link.lower() for link in self.getLinks(self.revisionList[0])["internal"]}
 
-        return self.revisionList[0]
+    def updateLinks(self):
+        self.linkGraph.update({self.pageName: self.currentLinks()})
 
     def revisionListHTML(self, current=-1, source=False):
         if not self.revisions: return "None"
@@ -193,6 +267,12 @@ class WikiPage(object):
 
         wanted = self.revisions[revision]
 
+        if wanted is None:
+            wanted = self.loadRevision(revision)
+
+            # unparseable revision got moved out of the way, try another one
+            if wanted is None: return self.get(revision)
+
         if "page" in wanted:
             return wanted
         else:
@@ -205,20 +285,88 @@ class WikiPage(object):
 
         return page["page"]
     
-    def getLinks(self, revision=-1):
-        page = self.getPage(revision)
-        parsed, links = self.formatter.formatContents(page, withLinks=True)
+    def renderContents(self, revision):
+        return "".join(self.iterContents(revision))
+
+    def iterContents(self, revision):
+        existing = self.catalog.existing()
+        cached   = renderCache.get(self.pageName, revision)
+
+        if cached is not None and cached["missing"] == missingLinks(cached["links"], existing):
+            timing.count("renderHit")
+            yield cached["html"]
+            return
+
+        timing.count("renderMiss")
+        contents = self.getPage(revision)
+        links    = {"internal": set(), "external": set()}
+        html     = []
+
+        with timing.span("format"):
+            pageFormatter = wikiformat.WikiFormatter(existing)
+
+            for chunk in pageFormatter.iterContents(contents, links):
+                html.append(chunk)
+                yield chunk
+
+        links = sorted(links["internal"])
+
+        renderCache.put(self.pageName, revision,
+                        {"html": "".join(html), "links": links, "missing": missingLinks(links, existing)})
+
+    # the internal links of a revision, lowercased, without rendering it:
+    # the link graph has the latest revision's, older ones come from the
+    # render cache or a parse
+    def revisionLinks(self, revision):
+        if revision == self.revisionList[0]:
+            graph = self.linkGraph.load()
+            if self.linkGraph.stamp is not None: return graph.get(self.pageName, {}).get("links", [])
+
+        cached = renderCache.get(self.pageName, revision)
+        links  = cached["links"] if cached is not None else self.getLinks(revision)["internal"]
+
+        return sorted({link.lower() for link in links})
+
+    # (tag, last modified) for what getHTML returns: anything that changes
+    # the output changes the tag, or None for a page with nothing in it
+    def validators(self, revision=-1, source=False):
+        if not self.revisions: return None
+        if revision not in self.revisions: revision = self.revisionList[0]
+
+        latest   = self.revisionList[0]
+        modified = revstore.epochTime(latest)
+        missing  = []
 
-        return links
+        if not source:
+            links   = self.revisionLinks(revision)
+            missing = missingLinks(links, self.catalog.existing())
+
+            # pages coming and going change which links render as missing
+            if links and self.catalog.stamp is not None:
+                modified = max(modified, self.catalog.stamp[0] // 10**9)
+
+        state = [TEMPLATEVERSION, self.pageName, self.displayTitle, revision, latest, bool(source), missing]
+        tag   = hashlib.sha1(json.dumps(state).encode("utf-8")).hexdigest()[:20]
+
+        return tag, modified
+
+    def analyze(self, revision=-1):
+        return self.formatter.analyzeContents(self.getPage(revision))
+
+    def getLinks(self, revision=-1):
+        return self.analyze(revision)[1]
 
     def getHTML(self, revision=-1, source=False, *, onlyContents=False):
+        return "".join(self.iterHTML(revision, source, onlyContents=onlyContents))
+
+    def iterHTML(self, revision=-1, source=False, *, onlyContents=False):
         formatDict = {}
         formatDict["page"]  = self.title
         formatDict["title"] = self.displayTitle
 
         if not self.revisions:
             if onlyContents:
-                return ""
+                return
 
             contents    = "\"{0}\" is empty - fix that.".format(self.displayTitle)
             revision    = "What revision?"
@@ -237,45 +385,61 @@ class WikiPage(object):
                 sourcelink  = "?page={0};rev={1}".format(self.title, revision)
 
             else:
-                contents = self.formatter.formatContents(contents)
+                contents = self.iterContents(revision)
                 sourcename  = "Edit {0} here".format(self.displayTitle)
                 sourcelink  = "?page={0};rev={1};source=1".format(self.title, revision)
 
+        if isinstance(contents, str):
+            contents = [contents]
+
         if onlyContents:
-            return contents
+            yield from contents
+            return
 
-        formatDict["content"]       = contents
         formatDict["revision"]      = revision
         formatDict["revisions"]     = revisions
         formatDict["sourceLink"]    = sourcelink
         formatDict["sourceName"]    = sourcename
-        
-        if source:
-            return addInner.safe_substitute(formatDict)
-        else:
-            return inner.safe_substitute(formatDict)
+
+        head, tail = addInner if source else inner
+
+        with timing.span("template"):
+            head = head.safe_substitute(formatDict)
+            tail = tail.safe_substitute(formatDict)
+
+        yield head
+        yield from contents
+        yield tail
 
     def wordCounts(self, revision=-1):
-        pageCrap = NOTAGRE.sub("", self.getHTML(revision, onlyContents=True))
-        pageCrap = pageCrap.lower()
+        return self.analyze(revision)[0]
 
-        ret = collections.defaultdict(int)
+def missingLinks(links, existing):
+    if existing is None: return []
+    return [link for link in links if link.lower() not in existing]
 
-        for word in pageCrap.split():
-            per = set()
+# rebuilds both the page catalog and the link graph, and clears out the
+# empty directories lookups used to leave behind
+def rebuildCatalog(pageDir="pages"):
+    entries = {}
+    links   = {}
 
-            word = WORDRE.search(word)
-            if not word: continue
-            word = word.group(1).lower()
+    for page in os.listdir(pageDir):
+        if not os.path.isdir(pageDir + os.sep + page): continue
 
-            ret[word] += 1
+        try:
+            wikiPage = WikiPage(page, pageDir)
+        except ValueError:
             continue
 
-            for i in range(len(word)):
-                for j in range(i+1, len(word)+1):
-                    per |= {word[i:j]}
+        if wikiPage.pruneEmpty(): continue
+
+        entries[page] = wikiPage.catalogEntry()
+        links[page]   = wikiPage.currentLinks()
 
-            for i in per:
-                ret[i] += 1
+    replaceCatalog(pageDir, entries, links)
+    return len(entries)
 
-        return dict(ret)
+def replaceCatalog(pageDir, entries, links):
+    catalog.getCatalog(pageDir).update(entries, replace=True)
+    linkgraph.getLinkGraph(pageDir).update(links, replace=True)
@@ -1,11 +1,32 @@
 #!/usr/bin/env python3
 
 import sys, os
+import re
+import math
 import collections
-import shelve
+import multiprocessing
+import functools
+import heapq
+import urllib.parse
 import cgi
 
-from . import wikipage
+from . import wikipage, searchindex, revstore, catalog, timing, termdict
+
+DEFAULTBACKEND = "shelve"
+QUERYCACHE     = 128
+
+# "classic" is the original occurrence count plus title and link bonuses;
+# "bm25" swaps the occurrence count for BM25 over stored document frequencies
+SCORING        = ("classic", "bm25")
+DEFAULTSCORING = "classic"
+
+BM25K1         = 1.2
+BM25B          = 0.75
+BM25SCALE      = 10
+
+# a query word, possibly with wildcards: foo* is a prefix, *foo* a substring
+# and *foo a suffix
+QUERYRE = re.compile("(\\*?)([a-z0-9]+(?:'[a-z0-9]*)?)(\\*?)")
 
 HTMLTEMPLATE = """\
 <div class="wikiSearch">
@@ -13,72 +34,190 @@ HTMLTEMPLATE = """\
   <ul class="searchResults">
 {result}
   </ul>
+{pages}
 </div>"""
 
 SEARCHTEMPLATE = """    <li class="searchResult"><a href="?page={page}">{title}</a> (relevance: {relevance})</li>"""
 
+PAGESTEMPLATE = """  <div class="searchPages">{shown} {links}</div>"""
+
+PAGELINK = """<a href="?q={query}&amp;start={start}&amp;count={count}">{text}</a>"""
+
 NORESULTS = """No results for "{query}" found."""
 
+# -> (page, latest revision, mtime, words, internal links, catalog entry);
+# the entry is None for a directory prune took away, see WikiPage.pruneEmpty
+def analyzePage(page, pageDir="pages", prune=False):
+    wikiPage = wikipage.WikiPage(page, pageDir)
+
+    if prune and wikiPage.pruneEmpty():
+        return (page, None, None, None, None, None)
+
+    mtime    = revstore.modifiedTime(wikiPage.postDir)
+    entry    = wikiPage.catalogEntry()
+
+    if not wikiPage.revisionList:
+        return (page, None, mtime, None, set(), entry)
+
+    revision     = wikiPage.revisionList[0]
+    words, links = wikiPage.analyze(revision)
+
+    return (page, revision, mtime, words, links['internal'], entry)
+
 class WikiSearcher(object):
-    def __init__(self, searchFile="wikiSearchDB", pageDir="pages"):
+    def __init__(self, searchFile="wikiSearchDB", pageDir="pages", backend=None, scoring=None):
+        if backend is None: backend = DEFAULTBACKEND
+        if scoring is None: scoring = DEFAULTSCORING
+
         self.searchFile = os.path.abspath(searchFile)
         self.pageDir    = os.path.abspath(pageDir)
 
         if not os.path.isdir(self.pageDir):
             raise IOError("\"{}\" is not a directory".format(pageDir))
 
-        self.searchDB   = shelve.open(searchFile, writeback=True)
+        if backend not in searchindex.BACKENDS:
+            raise ValueError("unknown search backend \"{}\"".format(backend))
+
+        if scoring not in SCORING:
+            raise ValueError("unknown scoring \"{}\"".format(scoring))
+
+        self.scoring    = scoring
+
+        self.index      = searchindex.BACKENDS[backend](self.searchFile)
+        self.catalog    = catalog.getCatalog(self.pageDir)
+
+        # query terms -> (index generation, results)
+        self.queryCache = collections.OrderedDict()
+        self.termDict   = None
+        self.dictStamp  = None
+        self.dictFile   = self.searchFile + "Dict." + backend
 
     def sync(self):
-        self.searchDB.sync()
+        with timing.span("indexCommit"):
+            self.index.commit()
+
+    # picks up other processes' commits; a long-lived searcher calls this
+    # before each request
+    def refresh(self):
+        self.index.refresh()
+
+    def syncAll(self, debug=False, workers=1):
+        self.index.clear()
+
+        pages = [page for page in os.listdir(self.pageDir)
+                      if os.path.isdir(self.pageDir + os.sep + page) and wikipage.WikiPage.validTitle(page)]
+
+        # the catalog and link graph come out of the same pass over the pages
+        entries, links = self.syncPages(pages, debug, workers, prune=True)
+        wikipage.replaceCatalog(self.pageDir, entries, links)
+
+        self.sync()
+        self.updateTermDictionary()
+
+    # -> ({page: catalog entry}, {page: links}) for the pages synced
+    def syncPages(self, pages, debug=False, workers=1, prune=False):
+        analyze = functools.partial(analyzePage, pageDir=self.pageDir, prune=prune)
+        entries = {}
+        links   = {}
+
+        if workers <= 1:
+            self.storeAnalyses(map(analyze, pages), entries, links, debug)
+            return entries, links
+
+        # the pool only analyses pages, this process stays the sole index writer
+        with multiprocessing.Pool(workers) as pool:
+            self.storeAnalyses(pool.imap_unordered(analyze, pages, 8), entries, links, debug)
 
-    def syncAll(self, debug=False):
-        for curPage in self.searchDB:
-            del self.searchDB[curPage]
+        return entries, links
+
+    def storeAnalyses(self, analyses, entries, links, debug=False):
+        for page, revision, mtime, words, pageLinks, entry in analyses:
+            self.index.removePage(page)
+            if entry is None: continue
+
+            if words:
+                if debug:
+                    print("{} ({}):".format(page, revision))
+                    print("  w:", words)
+                    print("  l:", pageLinks, "\n")
+
+                self.storeRevision(page, revision, words, pageLinks, entry["title"])
+
+            self.index.setManifest(page, revision, mtime)
+
+            entries[page] = entry
+            links[page]   = {link.lower() for link in pageLinks}
+
+    def syncChanged(self, debug=False, workers=1):
+        manifest = self.index.manifest()
+        present  = set()
+        changed  = []
 
         for page in os.listdir(self.pageDir):
-            self.syncPage(page, noSync=True, debug=debug)
+            pagePath = self.pageDir + os.sep + page
+            if not os.path.isdir(pagePath) or not wikipage.WikiPage.validTitle(page): continue
+
+            present.add(page)
+
+            mtime = revstore.modifiedTime(pagePath)
+            known = manifest.get(page)
+
+            if known is not None:
+                if known[1] == mtime: continue
+
+                # the history changed, but maybe not its latest revision
+                wikiPage = wikipage.WikiPage(page, self.pageDir)
+                latest   = wikiPage.revisionList[0] if wikiPage.revisionList else None
+
+                if latest == known[0]:
+                    self.index.setManifest(page, latest, mtime)
+                    continue
+
+            changed.append(page)
+
+        self.syncPages(changed, debug, workers)
+
+        for page in (set(manifest) | set(self.index.pages())) - present:
+            if debug: print("{} removed".format(page))
+            self.index.removePage(page)
 
         self.sync()
+        self.updateTermDictionary()
 
     def syncPage(self, page, noSync=False, debug=False, revision=-1):
-        self.searchDB[page] = {}
+        self.index.removePage(page)
 
-        wikiPage = wikipage.WikiPage(page)
+        wikiPage = wikipage.WikiPage(page, self.pageDir)
+        latest   = None
 
-        if not wikiPage.revisionList:
-            del self.searchDB[page]
-            return
+        if wikiPage.revisionList:
+            latest = wikiPage.revisionList[0]
 
-        if revision == -1:
-            revision = wikiPage.revisionList[0]
+            if revision == -1:
+                revision = latest
 
-        ret = self.syncRevision(page, revision, debug)
+            self.syncPageObject(wikiPage, revision, debug, add=True)
 
-        if None not in ret:
-            newRev = {"words": ret[0], "links": ret[1]}
-            self.searchDB[page][revision] = newRev
-        else:
-            del self.searchDB[page]
+        self.index.setManifest(page, latest, revstore.modifiedTime(wikiPage.postDir))
 
         if not noSync: self.sync()
 
     def syncRevision(self, page, revision=-1, debug=False):
         pagePath = self.pageDir + os.sep + page
-        if not os.path.isdir(pagePath): return ret
+        if not os.path.isdir(pagePath): return (None, None)
 
-        if revision == -1: revision = wikiPage.revisionList[0]
+        wikiPage = wikipage.WikiPage(page, self.pageDir)
 
-        wikiPage = wikipage.WikiPage(page)
+        if revision == -1: revision = wikiPage.revisionList[0]
 
-        return syncPageObject(wikiPage, revision, debug)
+        return self.syncPageObject(wikiPage, revision, debug)
 
     def syncPageObject(self, page, revision, debug=False, add=False):
         ret = (None, None)
 
         name = page.pageName
-        pageWords = page.wordCounts(revision)
-        pageLinks = page.getLinks(revision)['internal']
+        pageWords, pageLinks = page.analyze(revision)
+        pageLinks = pageLinks['internal']
 
         if pageWords:
             ret = (pageWords, pageLinks)
@@ -89,41 +228,136 @@ class WikiSearcher(object):
                 print("  l:", pageLinks, "\n")
 
         if add and None not in ret:
-            if name not in self.searchDB: self.searchDB[name] = {}
-            newRev = {"words": ret[0], "links": ret[1]}
-            self.searchDB[name][revision] = newRev
-
+            self.storeRevision(name, revision, *ret, title=page.displayTitle)
 
         return ret
 
-    def search(self, query):
-        ret = collections.defaultdict(int)
-        query = query.lower()
+    def storeRevision(self, page, revision, words, links, title=None):
+        self.index.storeRevision(page, revision, self.makeRecord(page, words, links, title))
 
-        for page in self.searchDB:
-            tmp = self.searchPage(query, page)
-            if tmp: ret[page] = tmp
+    # the title as it's shown: page names are stored lowercase, so nicify
+    # alone can't find the word boundaries in them
+    def pageTitle(self, page):
+        entry = self.catalog.get(page)
 
-        return dict(ret)
+        if entry is None: return wikipage.formatter.nicify(page[0].upper() + page[1:])
+        return entry["title"]
 
-    def searchPage(self, query, page):
-        ret = 0
-        pageWords = self.searchDB[page]
+    # everything scoring needs that doesn't depend on the query, worked out
+    # once at index time; title is the display title, see pageTitle
+    @staticmethod
+    def makeRecord(page, words, links, title=None):
+        if title is None: title = wikipage.formatter.nicify(page[0].upper() + page[1:])
 
-        query = query.lower()
+        linkWords = []
+        linkTerms = collections.Counter()
 
-        for word in wikipage.WORDRE.findall(query):
-            if word in page: ret += 2*len(word)
+        for link in links:
+            linkNice   = wikipage.formatter.nicify(link)
+            linkWords += wikipage.WORDRE.findall(linkNice.lower())
 
-            ret += pageWords.get(word, 0)
-        
-        return ret
+            for word in linkNice.split():
+                linkTerms[word.lower()] += 1
+
+        return {"words":      words,
+                "links":      links,
+                "titleWords": wikipage.WORDRE.findall(title.lower()),
+                "linkWords":  linkWords,
+                "title":      title.lower(),
+                "linkTerms":  dict(linkTerms),
+                "linkPages":  sorted({link.lower() for link in links}),
+                "length":     sum(words.values())}
+
+    def candidates(self, query):
+        with timing.span("candidates"):
+            return self.index.candidates(wikipage.WORDRE.findall(query.lower()))
+
+    @staticmethod
+    def queryKey(query):
+        # scoring only looks at the query's words, never their order
+        return tuple(sorted("".join(match) for match in QUERYRE.findall(query.lower())))
+
+    # queries only load the dictionary, the syncs keep it up to date (see
+    # updateTermDictionary); words first saved since the last sync don't
+    # expand until the next one
+    def termDictionary(self):
+        try:
+            stat  = os.stat(self.dictFile)
+            stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            stamp = None
+
+        if stamp is not None and stamp != self.dictStamp:
+            self.termDict  = termdict.TermDictionary.load(self.dictFile)
+            self.dictStamp = stamp
+
+        # an index from before the dictionary gets one on first use
+        if self.termDict is None: self.updateTermDictionary()
+
+        return self.termDict
+
+    # rebuilt only when the vocabulary changed, not for every commit
+    def updateTermDictionary(self):
+        terms = sorted(set(self.index.terms()))
+
+        if self.termDict is None: self.termDict = termdict.TermDictionary.load(self.dictFile)
+        if self.termDict is not None and self.termDict.terms == terms: return self.termDict
+
+        with timing.span("termDict"):
+            self.termDict = termdict.TermDictionary(terms, self.index.generation())
+            self.termDict.save(self.dictFile)
+
+        stat           = os.stat(self.dictFile)
+        self.dictStamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+        return self.termDict
+
+    def expandQuery(self, query):
+        if "*" not in query: return query
+
+        words = []
+
+        for before, word, after in QUERYRE.findall(query.lower()):
+            if before:
+                words += self.termDictionary().substring(word, suffix=not after)
+            elif after:
+                words += self.termDictionary().prefix(word)
+            else:
+                words.append(word)
+
+        return " ".join(words)
 
     def search(self, query):
-        pageRanks = collections.defaultdict(int)
+        key        = self.queryKey(query)
+        generation = self.index.generation()
+        cached     = self.queryCache.get(key)
+
+        if cached is not None and cached[0] == generation:
+            timing.count("queryHit")
+            self.queryCache.move_to_end(key)
+            return dict(cached[1])
+
+        ret = self.rankPages(self.expandQuery(query))
 
-        for page in self.searchDB:
-            result = self.searchPage(query, page)
+        self.queryCache[key] = (generation, ret)
+        self.queryCache.move_to_end(key)
+
+        while len(self.queryCache) > QUERYCACHE:
+            self.queryCache.popitem(last=False)
+
+        return dict(ret)
+
+    def rankPages(self, query):
+        pageRanks  = collections.defaultdict(int)
+        queryWords = wikipage.WORDRE.findall(query.lower())
+        stats      = None
+
+        if self.scoring == "bm25":
+            with timing.span("indexRead"):
+                stats = self.index.documentStats(set(queryWords))
+
+        for page in self.candidates(query):
+            result = self.searchPage(query, page, queryWords, stats)
             pageRanks[page] += result[0]
 
             for i in result[1]:
@@ -137,18 +371,22 @@ class WikiSearcher(object):
 
         return ret
 
-    def searchPage(self, query, page):
-        if page not in self.searchDB: raise IndexError("no such page {}".format(page))
+    def searchPage(self, query, page, queryWords=None, stats=None):
+        with timing.span("indexRead"):
+            revisions = self.index.revisions(page)
 
-        revCount = len(self.searchDB[page])
+        timing.count("searchPages")
+
+        if not revisions: raise IndexError("no such page {}".format(page))
+
+        if queryWords is None: queryWords = wikipage.WORDRE.findall(query.lower())
+
+        revCount = len(revisions)
 
-        if revCount == 0:
-            return [-0x7FFFFFFF, {}]
-        
         ret = [0, collections.defaultdict(int)]
 
-        for revision in self.searchDB[page]:
-            result = self.searchRevision(query, page, revision)
+        for revision in revisions:
+            result = self.searchRevision(query, page, revision, revisions[revision], queryWords, stats)
 
             ret[0] += result[0]
 
@@ -162,117 +400,164 @@ class WikiSearcher(object):
 
         return ret
 
-    def searchRevision(self, query, page, revision):
+    def searchRevision(self, query, page, revision, rev=None, queryWords=None, stats=None):
         page = page.lower()
-        wikiPage = wikipage.WikiPage(page)
-        nicename = wikiPage.niceName.lower()
 
-        if revision not in self.searchDB[page]:
-            raise IndexError("page {} has no revision {}".format(page, revision))
+        if rev is None:
+            revisions = self.index.revisions(page)
+
+            if revision not in revisions:
+                raise IndexError("page {} has no revision {}".format(page, revision))
+
+            rev = revisions[revision]
+
+        # indexes from before the stored features get them worked out here
+        if "linkTerms" not in rev:
+            rev = self.makeRecord(page, rev["words"], rev["links"], self.pageTitle(page))
+
+        if queryWords is None: queryWords = wikipage.WORDRE.findall(query.lower())
 
-        rev = self.searchDB[page][revision]
         words = rev["words"]
-        links = rev["links"]
+        title = rev["title"]
 
         ret = [0, {}]
 
-        query = query.lower()
-        queryWords = wikipage.WORDRE.findall(query)
-
         for word in queryWords:
-            if word in nicename:
+            if word in title:
                 ret[0] += 10 * len(word)
 
-            occurences = words.get(word, 0)
-            ret[0] += occurences
+        if stats is None:
+            for word in queryWords:
+                ret[0] += words.get(word, 0)
+        else:
+            ret[0] += BM25SCALE * self.bm25(queryWords, words, rev["length"], stats)
 
-        for link in links:
-            linkNice = wikiPage.nicify(link)
+        linkTerms = rev["linkTerms"]
 
-            for word in linkNice.split():
-                if word.lower() in queryWords:
-                    ret[0] += 2 * len(word)
+        for word in set(queryWords):
+            if word in linkTerms:
+                ret[0] += 2 * len(word) * linkTerms[word]
 
         if ret[0] > 0:
-            for link in links:
-                link = link.lower()
+            for link in rev["linkPages"]:
                 ret[1][link] = ret[0] / 5
 
         return ret
 
+    @staticmethod
+    def bm25(queryWords, words, length, stats):
+        documents, averageLength, frequencies = stats
+        score = 0.0
+
+        for word in queryWords:
+            count = words.get(word, 0)
+            if not count: continue
+
+            frequency = frequencies.get(word, 0)
+            idf       = math.log(1 + (documents - frequency + 0.5) / (frequency + 0.5))
+            norm      = 1 - BM25B + BM25B * length / (averageLength or 1)
+
+            score += idf * count * (BM25K1 + 1) / (count + BM25K1 * norm)
+
+        return score
+
     def searchHTML(self, query, rCount=-1, rStart=0):
-        results = self.search(query)
-        rSorted = list(sorted(results, reverse=True, key=(lambda x: results[x])) )
+        with timing.span("search"):
+            results = self.search(query)
+
+        rStart = max(rStart, 0)
+
+        # only the rows on this page get sorted (nlargest keeps sorted()'s
+        # order for ties) and rendered
+        with timing.span("rank"):
+            if rCount < 0:  rSorted = sorted(results, reverse=True, key=results.get)[rStart:]
+            else:           rSorted = heapq.nlargest(rStart + rCount, results, key=results.get)[rStart:]
 
         resultsPage = []
-        retDict = {"query": query}
+        retDict = {"query": cgi.escape(query), "pages": ""}
         formatDict = {}
 
-        if rCount == -1:
-            rEnd = len(rSorted)
-        else:
-            rEnd += rStart
-
-        if not rSorted:
+        if not results:
             formatDict['query'] = cgi.escape(query)
 
             resultsPage = [NORESULTS.format(**formatDict)]
         
-        elif rStart >= len(rSorted):
+        elif not rSorted:
             resultsPage = ["No results found past this point."]
 
-        for result in rSorted[rStart:rEnd]:
-            page = wikipage.WikiPage(result)
-
+        for result in rSorted:
             formatDict['relevance'] = results[result]
             formatDict['page']      = cgi.escape(result)
-            formatDict['title']     = cgi.escape(page.displayTitle)
+            formatDict['title']     = cgi.escape(self.pageTitle(result))
 
             resultsPage.append(SEARCHTEMPLATE.format(**formatDict))
 
+        if rCount > 0 and results:
+            retDict["pages"] = self.pageLinks(query, len(results), rCount, rStart)
+
         ret = "\n".join(resultsPage)
 
         retDict["result"] = ret
 
         return HTMLTEMPLATE.format(**retDict)
 
-    def __del__(self):
-        self.searchDB.sync()
+    @staticmethod
+    def pageLinks(query, total, rCount, rStart):
+        links = []
+        query = urllib.parse.quote_plus(query)
+
+        if rStart > 0:
+            links.append(PAGELINK.format(query=query, start=max(rStart - rCount, 0), count=rCount,
+                                         text="previous"))
+
+        if rStart + rCount < total:
+            links.append(PAGELINK.format(query=query, start=rStart + rCount, count=rCount, text="next"))
+
+        if rStart < total:  shown = "{0}-{1} of {2}".format(rStart + 1, min(rStart + rCount, total), total)
+        else:               shown = "{0} results".format(total)
+
+        return PAGESTEMPLATE.format(shown=shown, links=" ".join(links))
+
+    def close(self):
+        if self.index is None: return
+
+        self.sync()
+        self.index.close()
+        self.index = None
 
 
 class WikiSearcherDeep(WikiSearcher):
     def __init__(self, searchFile="deepSearchDB", pageDir="pages"):
         super().__init__(searchFile, pageDir)
 
-    def syncPage(self, page, noSync=False, debug=False):
-        self.searchDB[page] = {}
+    # every revision gets indexed, which analyzePage doesn't do
+    def syncPages(self, pages, debug=False, workers=1, prune=False):
+        entries = {}
+        links   = {}
 
-        wikiPage = wikipage.WikiPage(page)
+        for page in pages:
+            wikiPage = wikipage.WikiPage(page, self.pageDir)
 
-        if not wikiPage.revisionList:
-            del self.searchDB[page]
-            return
+            if prune and wikiPage.pruneEmpty():
+                self.index.removePage(page)
+                continue
 
-        revisions = {}
+            self.syncPage(page, noSync=True, debug=debug)
 
-        addedThings = False
+            entries[page] = wikiPage.catalogEntry()
+            links[page]   = wikiPage.currentLinks()
 
-        for rev in wikiPage.revisions:
-            ret = self.syncRevision(page, rev, debug)
+        return entries, links
 
-            if None not in ret:
-                addedThings = True
-                words = ret[0]
-                links = ret[1]
-            else:
-                words = {}
-                links = set()
+    def syncPage(self, page, noSync=False, debug=False):
+        self.index.removePage(page)
 
-            revisions[rev] = {"words": words, "links": links}
+        wikiPage = wikipage.WikiPage(page, self.pageDir)
 
-        if addedThings:
-            self.searchDB[page].update(revisions)
-        else:
-            del self.searchDB[page]
+        for rev in wikiPage.revisions:
+            self.syncPageObject(wikiPage, rev, debug, add=True)
+
+        latest = wikiPage.revisionList[0] if wikiPage.revisionList else None
+        self.index.setManifest(page, latest, revstore.modifiedTime(wikiPage.postDir))
 
-        if not noSync: self.searchDB.sync()
+        if not noSync: self.sync()